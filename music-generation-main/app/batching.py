@@ -0,0 +1,68 @@
+import os
+import asyncio
+import logging
+from io import BytesIO
+from executor import generate_batch
+from util import check_generation
+
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 10))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 8))
+
+
+class MicroBatcher:
+    """
+    Collects concurrent /generate requests for the same model and runs them as one batched predict.
+
+    A batch is flushed `window` seconds after its first request arrives, or as soon as it holds
+    `max_batch_size` requests.
+    """
+
+    def __init__(self, executor, window=BATCH_WINDOW_MS / 1000, max_batch_size=MAX_BATCH_SIZE):
+        self.executor = executor
+        self.window = window
+        self.max_batch_size = max(1, max_batch_size)
+        self._pending = {}
+        self._timers = {}
+
+    async def submit(self, name, length, prefix, duration=None, seed=None):
+        """
+        Returns (decided, buffer) of this request once its batch is generated.
+        Raises QueueFullError right away when the inference executor has no room left, and ValueError for
+        a request that cannot be generated, which would fail the whole batch.
+        """
+        check_generation(length, prefix, name)
+        self.executor.reserve()
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(name, [])
+        pending.append((length, prefix, duration, seed, future))
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(name)
+        elif name not in self._timers:
+            self._timers[name] = asyncio.get_running_loop().call_later(self.window, self._flush, name)
+        return await future
+
+    def _flush(self, name):
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(name, [])
+        if not batch:
+            return
+        asyncio.ensure_future(self._run(name, batch))
+
+    async def _run(self, name, batch):
+        lengths, prefixes, durations, seeds, futures = (list(column) for column in zip(*batch))
+        logging.warning(f"batch {name}: {len(batch)}")
+        try:
+            results = await self.executor.run(generate_batch, name, lengths, prefixes, durations, seeds,
+                                              requests=len(batch), reserved=True)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                decided, midi = result
+                future.set_result((decided, BytesIO(midi)))
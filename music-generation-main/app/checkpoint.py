@@ -0,0 +1,124 @@
+"""
+Inference-only checkpoint format.
+
+A training checkpoint `checkpoint/<name>.pt` also holds the optimizer state and the loss history.
+The converter keeps only the model weights:
+  <name>.bin   raw tensor data, every tensor aligned to ALIGNMENT bytes, read through np.memmap
+  <name>.json  manifest with the model hyperparameters and the dtype/shape/offset of every tensor
+
+Usage:
+  python checkpoint.py                  # converts every model found in checkpoint/
+  python checkpoint.py rnn transformer --checkpoint-dir ../checkpoint
+"""
+import os
+import json
+import logging
+import argparse
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def manifest_path(prefix):
+    return f'{prefix}.json'
+
+
+def weights_path(prefix):
+    return f'{prefix}.bin'
+
+
+def read_manifest(prefix):
+    """Manifest of the slim checkpoint `prefix`, None if there is none"""
+    path = manifest_path(prefix)
+    if not os.path.exists(path) or not os.path.exists(weights_path(prefix)):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_weights(state_dict, hparams, model_name, prefix):
+    tensors = {}
+    offset = 0
+    with open(weights_path(prefix), 'wb') as f:
+        for key, tensor in state_dict.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            tensors[key] = {'dtype': str(array.dtype), 'shape': list(array.shape), 'offset': offset}
+            f.write(array.tobytes())
+            offset += array.nbytes
+
+    manifest = {'format': FORMAT_VERSION, 'model': model_name, 'hparams': hparams, 'tensors': tensors}
+    with open(manifest_path(prefix), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_weights(prefix, manifest=None):
+    """
+    State dict of the slim checkpoint `prefix`. The tensors are copy-on-write memory maps of the
+    weights file, nothing is read before load_state_dict copies them into the model.
+    """
+    manifest = manifest or read_manifest(prefix)
+    path = weights_path(prefix)
+    state_dict = {}
+    for key, info in manifest['tensors'].items():
+        shape = tuple(info['shape'])
+        if not shape or 0 in shape:
+            state_dict[key] = torch.from_numpy(np.zeros(shape, dtype=info['dtype']))
+            continue
+        array = np.memmap(path, dtype=info['dtype'], mode='c', offset=info['offset'], shape=shape)
+        state_dict[key] = torch.from_numpy(array)
+    return state_dict
+
+
+def check_shapes(state_dict, model, model_name, hparams):
+    """Raises ValueError when the tensors of state_dict are not the ones of model built with hparams"""
+    expected = {key: tuple(tensor.shape) for key, tensor in model.state_dict().items()}
+    found = {key: tuple(tensor.shape) for key, tensor in state_dict.items()}
+    mismatches = [f'{key}: {found.get(key)} in the checkpoint, {expected.get(key)} for the hparams'
+                  for key in sorted(set(expected) | set(found)) if expected.get(key) != found.get(key)]
+    if mismatches:
+        raise ValueError(f'{model_name} checkpoint does not match hparams {hparams}, pass the ones it was '
+                         f'trained with in --hparams: ' + '; '.join(mismatches[:5]))
+
+
+def convert(model_name, checkpoint_dir, hparams=None):
+    from util import DEFAULT_HPARAMS, CHECKPOINT_NAMES, build_model
+
+    prefix = os.path.join(checkpoint_dir, CHECKPOINT_NAMES[model_name])
+    source = f'{prefix}.pt'
+    if not os.path.exists(source):
+        logging.warning(f"convert: {source} not found")
+        return None
+    checkpoint = torch.load(source, map_location='cpu')
+    hparams = {**DEFAULT_HPARAMS[model_name], **(hparams or {})}
+    # the manifest hparams build the model at load time
+    check_shapes(checkpoint['model_state_dict'], build_model(model_name, hparams), model_name, hparams)
+    manifest = save_weights(checkpoint['model_state_dict'], hparams, model_name, prefix)
+    logging.warning(f"convert: {source} -> {weights_path(prefix)} ({len(manifest['tensors'])} tensors)")
+    return manifest
+
+
+def main():
+    from util import BASE_DIR, CHECKPOINT_NAMES
+
+    parser = argparse.ArgumentParser(description="Convert training checkpoints into inference-only weights files")
+    parser.add_argument('models', nargs='*', help=f'models to convert, all of {list(CHECKPOINT_NAMES)} by default')
+    parser.add_argument('--checkpoint-dir', default=f'{BASE_DIR}/checkpoint')
+    parser.add_argument('--hparams', type=json.loads, default={},
+                        help='JSON object overriding the default hyperparameters, e.g. \'{"hidden_size": 256}\'')
+    args = parser.parse_args()
+    unknown = set(args.models) - set(CHECKPOINT_NAMES)
+    if unknown:
+        parser.error(f'unknown models: {sorted(unknown)}')
+
+    for model_name in args.models or CHECKPOINT_NAMES:
+        convert(model_name, args.checkpoint_dir, args.hparams)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import asyncio
+
+
+class SingleFlight:
+    """
+    Runs one call per key at a time: a call made while another one with the same key is in flight
+    waits for it and gets its result (or its exception) instead of running again.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key, function, *args):
+        flight = self._flights.get(key)
+        if flight is None:
+            # a task of its own, so that a leader whose client went away does not cancel the others
+            flight = asyncio.ensure_future(function(*args))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(flight)
+
+    def stats(self):
+        calls = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / calls if calls else 0.0,
+        }
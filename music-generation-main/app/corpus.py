@@ -0,0 +1,168 @@
+"""
+Encoded training corpus.
+
+Encodes a folder of MIDI files in a process pool into:
+  tokens.bin   every piece as bos, its events + 3 and eos, int16, one after the other
+  offsets.npy  int64, piece i is tokens[offsets[i]:offsets[i+1]], empty when its file failed to encode
+  files.json   manifest with the path, content hash, duration, token count and failure reason of every file
+Both arrays are read through memory maps (see load_corpus), so nothing is held as Python ints.
+On a re-run, files whose content hash is in the previous manifest are copied over instead of encoded again.
+
+Usage:
+  python corpus.py dataset/orig                   # writes dataset/corpus
+  python corpus.py dataset/orig --output dataset/corpus_orig --workers 8
+"""
+import os
+import json
+import hashlib
+import logging
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import pretty_midi
+
+from model import bos_token, eos_token
+from processor import encode_pretty_midi
+
+FORMAT_VERSION = 1
+# bump when processor.encode_midi changes the tokens of a file, so that a re-run encodes everything again
+ENCODER_VERSION = 1
+MIDI_EXTENSIONS = ('.mid', '.midi')
+CHUNK_SIZE = 8
+
+
+def tokens_path(directory):
+    return os.path.join(directory, 'tokens.bin')
+
+
+def offsets_path(directory):
+    return os.path.join(directory, 'offsets.npy')
+
+
+def manifest_path(directory):
+    return os.path.join(directory, 'files.json')
+
+
+def midi_files(folder):
+    """MIDI files under folder, recursively, sorted"""
+    paths = []
+    for root, _, names in os.walk(folder):
+        paths += [os.path.join(root, name) for name in names if name.lower().endswith(MIDI_EXTENSIONS)]
+    return sorted(paths)
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def encode_file(path):
+    """(int16 tokens or None, stats) of one MIDI file, parsed once for both"""
+    try:
+        mid = pretty_midi.PrettyMIDI(midi_file=path)
+        events = np.asarray(encode_pretty_midi(mid), dtype=np.int16)
+        tokens = np.concatenate([[bos_token], events + 3, [eos_token]]).astype(np.int16)
+        return tokens, {'duration': float(mid.get_end_time()), 'tokens': len(tokens), 'error': None}
+    except Exception as e:
+        return None, {'duration': None, 'tokens': 0, 'error': f'{type(e).__name__}: {e}'}
+
+
+def load_corpus(directory):
+    """(tokens, offsets, manifest) of an encoded corpus, the arrays memory mapped read-only"""
+    with open(manifest_path(directory)) as f:
+        manifest = json.load(f)
+    offsets = np.load(offsets_path(directory), mmap_mode='r')
+    if offsets[-1] == 0:
+        return np.zeros(0, dtype=np.int16), offsets, manifest
+    return np.memmap(tokens_path(directory), dtype=np.int16, mode='r'), offsets, manifest
+
+
+def _previous(directory):
+    """Tokens and manifest entries by content hash of the corpus in directory, {} if it has none to reuse"""
+    try:
+        tokens, offsets, manifest = load_corpus(directory)
+    except (OSError, ValueError) as e:
+        if os.path.exists(manifest_path(directory)):
+            logging.warning(f"corpus: not reusing {directory}: {e}")
+        return {}
+    if manifest.get('format') != FORMAT_VERSION or manifest.get('encoder') != ENCODER_VERSION:
+        return {}
+    return {entry['sha256']: (tokens[offsets[i]:offsets[i + 1]], entry) for i, entry in enumerate(manifest['files'])}
+
+
+def build(folder, directory, workers=None):
+    """Encodes the MIDI files under folder into the corpus in directory, returns its manifest"""
+    os.makedirs(directory, exist_ok=True)
+    paths = midi_files(folder)
+    previous = _previous(directory)
+
+    with Pool(workers) as pool:
+        digests = pool.map(file_digest, paths, chunksize=CHUNK_SIZE)
+        changed = [path for path, digest in zip(paths, digests) if digest not in previous]
+        # results come back in the order of `changed`, and are consumed as the corpus is written
+        encoded = pool.imap(encode_file, changed, chunksize=CHUNK_SIZE)
+
+        entries = []
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        reused = 0
+        with open(tokens_path(directory) + '.tmp', 'wb') as f:
+            for i, (path, digest) in enumerate(zip(paths, digests)):
+                if digest in previous:
+                    tokens, stats = previous[digest]
+                    stats = {key: stats[key] for key in ('duration', 'tokens', 'error')}
+                    reused += 1
+                else:
+                    tokens, stats = next(encoded)
+                    if stats['error'] is not None:
+                        logging.warning(f"corpus: {path}: {stats['error']}")
+                if tokens is not None:
+                    f.write(np.ascontiguousarray(tokens, dtype=np.int16).tobytes())
+                offsets[i + 1] = offsets[i] + stats['tokens']
+                entries.append({'path': os.path.relpath(path, folder), 'sha256': digest, **stats})
+
+    manifest = {'format': FORMAT_VERSION, 'encoder': ENCODER_VERSION, 'files': entries}
+    with open(offsets_path(directory) + '.tmp', 'wb') as f:
+        np.save(f, offsets)
+    with open(manifest_path(directory) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    # the manifest goes last, a corpus is only read through it
+    for path in (tokens_path(directory), offsets_path(directory), manifest_path(directory)):
+        os.replace(path + '.tmp', path)
+    logging.warning(f"corpus: {len(paths)} files, {len(changed)} encoded, {reused} unchanged -> {directory}")
+    return manifest
+
+
+def summary(manifest):
+    """Duration and token statistics of the files that encoded, as the notebook's dataset_summary"""
+    encoded = [entry for entry in manifest['files'] if entry['error'] is None]
+    if not encoded:
+        return {'file_count': len(manifest['files']), 'failed': len(manifest['files'])}
+    lens_sec = [entry['duration'] for entry in encoded]
+    lens_token = [entry['tokens'] for entry in encoded]
+    return {
+        'file_count': len(manifest['files']),
+        'failed': len(manifest['files']) - len(encoded),
+        'min_sec': round(min(lens_sec), 2),
+        'max_sec': round(max(lens_sec), 2),
+        'avg_sec': round(sum(lens_sec) / len(lens_sec), 2),
+        'min_token': min(lens_token),
+        'max_token': max(lens_token),
+        'avg_token': round(sum(lens_token) / len(lens_token), 2),
+    }
+
+
+def main():
+    from util import BASE_DIR
+
+    parser = argparse.ArgumentParser(description="Encode a folder of MIDI files into a memory-mapped token corpus")
+    parser.add_argument('folder', help='folder searched recursively for .mid/.midi files')
+    parser.add_argument('--output', default=f'{BASE_DIR}/dataset/corpus')
+    parser.add_argument('--workers', type=int, default=None, help='processes, one per CPU by default')
+    args = parser.parse_args()
+
+    manifest = build(args.folder, args.output, args.workers)
+    logging.warning(f"corpus: {summary(manifest)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from util import registry, generate_buffers, generate_segment
+
+INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "thread")
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 1))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", 16))
+RETRY_AFTER = int(os.environ.get("RETRY_AFTER", 5))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _init_worker():
+    registry.preload()
+
+
+def preload_models():
+    registry.preload()
+    return registry.status()
+
+
+def generate_batch(name, lengths, prefixes, durations=None, seeds=None):
+    """
+    Runs inside an inference worker with the registry of that worker.
+    Returns a list of (decided, midi bytes) per row, bytes so that the result can leave a worker process.
+    """
+    results = generate_buffers(registry.get(name), lengths, prefixes, durations, seeds)
+    return [(decided, buffer.getvalue()) for decided, buffer in results]
+
+
+def generate_piece_segment(name, length, prefix=None, carry=None, seed=None):
+    """
+    Runs inside an inference worker with the registry of that worker.
+    The carry goes back to the caller, so that any worker can generate the next segment.
+    """
+    return generate_segment(registry.get(name), length, prefix, carry, seed)
+
+
+class InferenceExecutor:
+    """
+    Runs generation off the event loop, in a pool of threads or processes.
+
+    At most `workers` jobs run at once. Requests are counted, not jobs, so a batch of eight waits
+    as eight: once `queue_size` requests wait behind the running ones, new ones are refused with
+    QueueFullError instead of piling up. Requests held by the micro-batcher are reserved here as
+    soon as they arrive.
+    """
+
+    def __init__(self, kind=INFERENCE_EXECUTOR, workers=INFERENCE_WORKERS, queue_size=INFERENCE_QUEUE_SIZE):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        if kind == "process":
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        else:
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="inference")
+        # only touched from the event loop thread
+        self._waiting = 0
+        self._running = 0
+        self._slots = None
+        self._models_status = None
+        self._error = None
+
+    @property
+    def full(self):
+        return self._waiting >= self.queue_size
+
+    def reserve(self, requests=1):
+        """Counts requests that will reach run() later, once their batch is complete"""
+        if self.full:
+            logging.warning(f"inference queue full: {self._waiting} waiting")
+            raise QueueFullError()
+        self._waiting += requests
+
+    async def run(self, fn, *args, requests=1, reserved=False):
+        """fn(*args) in the pool, for `requests` requests, already counted by reserve() when `reserved`"""
+        if not reserved:
+            self.reserve(requests)
+        if self._slots is None:
+            # created here, bound to the running loop
+            self._slots = asyncio.Semaphore(self.workers)
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= requests
+        self._running += requests
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self._running -= requests
+            self._slots.release()
+
+    async def start(self):
+        """Loads the models in a worker, the executor is ready once it is done, failed if loading raised"""
+        try:
+            self._models_status = await self.run(preload_models)
+        except Exception as e:
+            self._error = f"{type(e).__name__}: {e}"
+            logging.exception(f"model preload failed")
+
+    @property
+    def ready(self):
+        return self._models_status is not None
+
+    def status(self):
+        # a process pool has its own registries, only the snapshot taken by start() is visible here
+        models = registry.status() if self.kind != "process" else self._models_status
+        status = {"ready": self.ready, "running": self._running, "waiting": self._waiting,
+                  "queue_size": self.queue_size, "models": models}
+        if self._error is not None:
+            status["error"] = self._error
+        return status
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
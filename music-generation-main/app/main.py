@@ -1,8 +1,22 @@
+import os
+import json
+import asyncio
 import logging
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+import pretty_midi
+from io import BytesIO
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from util import load_rnn, load_cnn, load_transformer, load_vae, load_gan, generate_buffer, GenerateRequest
+from util import (GenerateRequest, SegmentRequest, ContinueRequest, SteppingUnavailable, check_generation, check_segment,
+                  check_stepping, midi_buffer, result_key)
+from model import eos_token
+from model.decoding import duration_ticks
+from batching import MicroBatcher
+from executor import InferenceExecutor, QueueFullError, RETRY_AFTER, generate_piece_segment
+from sessions import SessionStore
+from processor import EventDecoder, notes_midi
+from result_cache import ResultCache
+from coalescing import SingleFlight
 
 
 app = FastAPI()
@@ -15,20 +29,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-model_dict = {}
+executor = InferenceExecutor()
+batcher = MicroBatcher(executor)
+sessions = SessionStore()
+results = ResultCache()
+flights = SingleFlight()
+
+# tokens decoded per job of a streamed generation
+STREAM_CHUNK = int(os.environ.get("STREAM_CHUNK", 16))
 
 
 @app.on_event("startup")
 async def startup():
-    global model_dict
     logging.warning(f"startup")
-    model_dict = {
-        "rnn": load_rnn(),
-        "cnn": load_cnn(),
-        "transformer": load_transformer(),
-        "vae": load_vae(),
-        "gan": load_gan()
-    }
+    # start() logs a failed preload, /ready then reports it
+    app.state.preload = asyncio.ensure_future(executor.start())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    executor.shutdown()
 
 
 @app.get("/")
@@ -36,23 +56,201 @@ async def root():
     return {"message": "OK"}
 
 
+@app.get("/ready")
+async def ready():
+    status = executor.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    # with a process pool, the prefix caches are the ones of the worker that started up
+    return {"result_cache": results.stats(), "prefix_cache": (executor.status()["models"] or {}).get("prefix_cache", {}),
+            "coalescing": flights.stats()}
+
+
+async def generate_piece(payload):
+    """(PrettyMIDI or None, MIDI bytes) of a GenerateRequest, from the result cache when it has it"""
+    # hashing a checkpoint the first time takes a while
+    key = await asyncio.get_running_loop().run_in_executor(None, result_key, payload)
+    midi = results.get(key) if key is not None else None
+    if midi is not None:
+        return None, midi
+    try:
+        decided, buffer = await batcher.submit(payload.model, payload.length, payload.prefix, payload.duration, payload.seed)
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Too many requests in flight", headers={"Retry-After": str(RETRY_AFTER)})
+    if key is not None:
+        results.put(key, buffer.getvalue())
+    return decided, buffer.getvalue()
+
+
 @app.post("/generate")
 async def generate(payload: GenerateRequest):
     # logging.warning(f"payload: {payload}")
     # logging.warning(f"payload.model: {payload.model}")
     # logging.warning(type(payload.model))
 
-    model_dict = {
-        "rnn": load_rnn(),
-        "cnn": load_cnn(),
-        "transformer": load_transformer(),
-        "vae": load_vae(),
-        "gan": load_gan()
-    }
-    decided, buffer = generate_buffer(model_dict[payload.model], payload.length, payload.prefix)
-    logging.warning(f"decided: {decided} buffer: {buffer}")
+    try:
+        check_generation(payload.length, payload.prefix, payload.model)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    # identical requests in flight, e.g. retries of a slow one, share a single generation
+    flight = (payload.model, payload.length, tuple(payload.prefix), payload.duration, payload.seed)
+    decided, midi = await flights.run(flight, generate_piece, payload)
+    buffer = BytesIO(midi)
+    logging.warning(f"decided: {None if decided is None else len(decided[0])} notes, buffer: {buffer}")
 
     if payload.is_mid:
-        return decided
+        # a result cache hit only has the file
+        return notes_midi(decided) if decided is not None else pretty_midi.PrettyMIDI(BytesIO(midi))
+
+    return StreamingResponse(buffer, media_type="audio/midi")
+
+
+async def next_segment(session, length):
+    async with session.lock:
+        if not session.finished:
+            try:
+                tokens, session.carry, session.finished = await executor.run(
+                    generate_piece_segment, session.model, length,
+                    session.prefix if session.carry is None else None, session.carry, session.seed)
+            except QueueFullError:
+                raise HTTPException(status_code=503, detail="Too many requests in flight", headers={"Retry-After": str(RETRY_AFTER)})
+            except SteppingUnavailable as e:
+                raise HTTPException(status_code=501, detail=str(e))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            session.tokens.extend(tokens)
+        else:
+            tokens = []
+    return {"id": session.id, "tokens": tokens, "position": len(session.prefix) + len(session.tokens),
+            "finished": session.finished}
+
+
+@app.post("/segments")
+async def start_segments(payload: SegmentRequest):
+    """Starts a piece and returns its first segment, continue it with /segments/{id}"""
+    require_stepping()
+    try:
+        check_segment(payload.prefix)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    session = sessions.create(payload.model, payload.prefix, payload.seed)
+    return await next_segment(session, payload.length)
 
+
+@app.post("/segments/{session_id}")
+async def continue_segments(session_id: str, payload: ContinueRequest):
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+    return await next_segment(session, payload.length)
+
+
+@app.get("/segments/{session_id}")
+async def segments_midi(session_id: str):
+    """The piece generated so far"""
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+    _, buffer = midi_buffer(session.prefix[1:], session.tokens)
     return StreamingResponse(buffer, media_type="audio/midi")
+
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_chunk(name, length, prefix=None, carry=None, seed=None):
+    try:
+        return await executor.run(generate_piece_segment, name, length, prefix, carry, seed)
+    except QueueFullError:
+        raise HTTPException(status_code=503, detail="Too many requests in flight", headers={"Retry-After": str(RETRY_AFTER)})
+    except SteppingUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def require_stepping():
+    """The step-by-step endpoints answer 501 when the served models are compiled, see scripting.py"""
+    try:
+        check_stepping()
+    except SteppingUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+
+
+def decode_notes(decoder, tokens):
+    notes = []
+    for token in tokens:
+        # pad/bos/eos are not events
+        note = decoder.push(token - 3) if token >= 3 else None
+        if note is not None:
+            notes.append({"pitch": note.pitch, "velocity": note.velocity, "start": note.start, "end": note.end})
+    return notes
+
+
+async def stream_events(payload, decoder, notes, chunk):
+    """
+    Events of a streamed generation:
+      notes   [{"pitch", "velocity", "start", "end"}, ...], the notes completed by the prefix or a chunk
+      tokens  {"tokens": [...]}, the tokens of a chunk
+      end     {"tokens": n}, once the piece reached eos, its length or its duration
+      error   {"status", "detail"}, instead of end when a chunk after the first one fails
+    The notes are the ones of the MIDI file /generate returns for the same request. The response has
+    started by then, so errors are sent as an event rather than a status code.
+    """
+    yield server_sent_event("notes", notes)
+    budget = None if payload.duration is None else duration_ticks(payload.duration)
+    remaining = payload.length - len(payload.prefix)
+    generated = 0
+    while chunk is not None:
+        tokens, carry, finished = chunk
+        # the chunk is cut where generation stops: eos, length or duration
+        kept, notes = [], []
+        for token in tokens[:remaining]:
+            if token == eos_token:
+                finished = True
+                break
+            kept.append(token)
+            notes += decode_notes(decoder, [token])
+            if budget is not None and decoder.ticks >= budget:
+                finished = True
+                break
+        remaining -= len(kept)
+        generated += len(kept)
+        yield server_sent_event("tokens", {"tokens": kept})
+        yield server_sent_event("notes", notes)
+        if finished or remaining <= 0:
+            break
+        try:
+            chunk = await stream_chunk(payload.model, min(STREAM_CHUNK, remaining), carry=carry)
+        except HTTPException as e:
+            yield server_sent_event("error", {"status": e.status_code, "detail": e.detail})
+            return
+        except Exception as e:
+            logging.exception(f"stream: chunk failed")
+            yield server_sent_event("error", {"status": 500, "detail": f"{type(e).__name__}: {e}"})
+            return
+    yield server_sent_event("end", {"tokens": generated})
+
+
+@app.post("/generate/stream")
+async def generate_stream(payload: GenerateRequest):
+    """/generate as server-sent events, sent as soon as each chunk of tokens is decoded"""
+    require_stepping()
+    # the request is checked while errors can still be answered with a status code
+    try:
+        check_generation(payload.length, payload.prefix, payload.model)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    decoder = EventDecoder()
+    notes = decode_notes(decoder, payload.prefix[1:])
+    chunk = None
+    remaining = payload.length - len(payload.prefix)
+    reached = payload.duration is not None and decoder.ticks >= duration_ticks(payload.duration)
+    if remaining > 0 and not reached:
+        # errors of the first chunk are still answered with a status code
+        chunk = await stream_chunk(payload.model, min(STREAM_CHUNK, remaining), payload.prefix, seed=payload.seed)
+    return StreamingResponse(stream_events(payload, decoder, notes, chunk), media_type="text/event-stream")
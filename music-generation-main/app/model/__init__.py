@@ -6,3 +6,35 @@ pad_token = 0
 bos_token = 1
 eos_token = 2
 batch_size = 32
+
+
+def prefix_lengths(target, prefix_len=None):
+    """Per-row prefix lengths of the right-padded `target`, the full width if not given"""
+    N, T = target.shape
+    if prefix_len is None:
+        return torch.full((N,), T, dtype=torch.long, device=target.device)
+    return prefix_len.to(target.device)
+
+
+def latent_noise(N, latent_dim, seeds=None):
+    """
+    Latent noise (N, latent_dim) of the rows of a batch. A row with a seed gets the noise of its own
+    torch.Generator, so that it does not depend on the rest of the batch; the others draw from the
+    global generator.
+    """
+    if seeds is None:
+        return torch.randn(N, latent_dim).to(device)
+    rows = [torch.randn(latent_dim) if seed is None else
+            torch.randn(latent_dim, generator=torch.Generator().manual_seed(int(seed)))
+            for seed in seeds]
+    return torch.stack(rows).to(device)
+
+
+def force_prefix(target, prefix_len, pos, generated):
+    """
+    Token at position `pos` of every row: the prefix token for rows whose prefix is longer than `pos`,
+    `generated` (N, 1) for the others.
+    """
+    if pos >= target.shape[1]:
+        return generated
+    return torch.where((prefix_len > pos).unsqueeze(1), target[:, pos:pos+1], generated)
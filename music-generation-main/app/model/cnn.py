@@ -1,20 +1,75 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from model import pad_token
+from model import pad_token, prefix_lengths, force_prefix
+from model.decoding import decode, limit_duration
 
 class CausalConv1d(nn.Module):
   def __init__(self, in_channels, out_channels, kernel_size, stride=1, dilation=1, groups=1, bias=True):
     super(CausalConv1d, self).__init__()
     self.padding = (kernel_size - 1) * dilation
     self.conv1d = nn.Conv1d(in_channels, out_channels, kernel_size, stride=stride, padding=self.padding, dilation=dilation, groups=groups, bias=bias)
+    self.step_linear = None
 
-  def forward(self, inputs):
+  def forward(self, inputs, queues=None):
     out = self.conv1d(inputs)
     if self.padding != 0:
+      if queues is not None:
+        queues.append(self._fill_queue(inputs))
       return out[:, :, : -self.padding]
     return out
 
+  def _fill_queue(self, inputs):
+    """
+    Ring buffer of the last `padding` inputs, the input of timestep t is kept at t % padding.
+    inputs:
+      inputs: tensor of size (N, C_in, T)
+    """
+    T = inputs.shape[2]
+    past = F.pad(inputs, (self.padding, 0))[:, :, -self.padding:]
+    return past.roll(T % self.padding, dims=2).contiguous()
+
+  def step(self, inputs, queues, t):
+    """
+    Fast WaveNet step: output of timestep t computed from the queued past inputs only.
+    inputs:
+      inputs: tensor of size (N, C_in), input of timestep t
+      queues: iterator over the ring buffers filled by forward(), one per dilated convolution
+      t: int, timestep of inputs
+    outputs:
+      out: tensor of size (N, C_out)
+    """
+    if self.padding == 0:
+      return self._step_linear(inputs)
+
+    queue = next(queues)
+    kernel_size, dilation = self.conv1d.kernel_size[0], self.conv1d.dilation[0]
+    # tap j of the kernel reads the input of timestep t - (kernel_size-1-j) * dilation
+    taps = [queue[:, :, (t - (kernel_size-1-j) * dilation) % self.padding] for j in range(kernel_size-1)]
+    taps.append(inputs)
+    out = self._step_linear(torch.cat(taps, dim=1))
+    queue[:, :, t % self.padding] = inputs
+    return out
+
+  def _step_linear(self, taps):
+    if self.step_linear is not None:
+      return self.step_linear(taps)
+    weight = self.conv1d.weight
+    return F.linear(taps, weight.permute(0, 2, 1).reshape(weight.shape[0], -1), self.conv1d.bias)
+
+  def linearize(self):
+    """
+    Copies the kernel into an nn.Linear over the concatenated taps that step() then uses,
+    e.g. so that the steps can be dynamically quantized. forward() keeps using the convolution.
+    """
+    weight = self.conv1d.weight
+    self.step_linear = nn.Linear(weight.shape[1] * weight.shape[2], weight.shape[0], bias=self.conv1d.bias is not None)
+    self.step_linear.to(weight.device)
+    with torch.no_grad():
+      self.step_linear.weight.copy_(weight.permute(0, 2, 1).reshape(weight.shape[0], -1))
+      if self.conv1d.bias is not None:
+        self.step_linear.bias.copy_(self.conv1d.bias)
+
 class ResBlock(nn.Module):
   def __init__(self, res_channels, skip_channels, kernel_size, dilation):
     super(ResBlock, self).__init__()
@@ -23,8 +78,8 @@ class ResBlock(nn.Module):
     self.conv_res = CausalConv1d(res_channels, res_channels, 1)
     self.conv_skip = CausalConv1d(res_channels, skip_channels, 1)
 
-  def forward(self, inputs):
-    dilated = self.conv_dilated(inputs)
+  def forward(self, inputs, queues=None):
+    dilated = self.conv_dilated(inputs, queues)
     dilated_split = torch.split(dilated, self.res_channels, dim=1)
     gated = torch.tanh(dilated_split[0]) * torch.sigmoid(dilated_split[1])
     out = self.conv_res(gated)
@@ -32,17 +87,34 @@ class ResBlock(nn.Module):
     skip = self.conv_skip(gated)
     return out, skip
 
+  def step(self, inputs, queues, t):
+    dilated = self.conv_dilated.step(inputs, queues, t)
+    dilated_split = torch.split(dilated, self.res_channels, dim=1)
+    gated = torch.tanh(dilated_split[0]) * torch.sigmoid(dilated_split[1])
+    out = self.conv_res.step(gated, queues, t)
+    out += inputs
+    skip = self.conv_skip.step(gated, queues, t)
+    return out, skip
+
 class ResStack(nn.Module):
   def __init__(self, res_channels, skip_channels, kernel_size, dilation_depth, num_repeat):
     super(ResStack, self).__init__()
     dilations = [2 ** d for d in range(dilation_depth)] * num_repeat
     self.res_blocks = nn.ModuleList([ResBlock(res_channels, skip_channels, kernel_size, d) for d in dilations])
 
-  def forward(self, inputs):
+  def forward(self, inputs, queues=None):
+    out = inputs
+    skips = 0
+    for res_block in self.res_blocks:
+      out, skip = res_block(out, queues)
+      skips += skip
+    return skips
+
+  def step(self, inputs, queues, t):
     out = inputs
     skips = 0
     for res_block in self.res_blocks:
-      out, skip = res_block(out)
+      out, skip = res_block.step(out, queues, t)
       skips += skip
     return skips
 
@@ -56,16 +128,55 @@ class WaveNet(nn.Module):
     self.linear1 = nn.Conv1d(embedding_dim, vocab_size, 1)
     self.relu2 = nn.ReLU()
     self.linear2 = nn.Conv1d(vocab_size, vocab_size, 1)
+    self.step_linear1 = None
+    self.step_linear2 = None
 
-  def forward(self, target, valid_len):
+  def forward(self, target, valid_len, queues=None):
+    """
+    queues: list, optional, filled with the ring buffers of every dilated convolution
+      so that decoding can continue with step()
+    """
     embedded = self.embedding(target)
     embedded = embedded.permute(0,2,1)
-    causal = self.causal(embedded)
-    skips = self.res_stack(causal)
+    causal = self.causal(embedded, queues)
+    skips = self.res_stack(causal, queues)
     linear = self.linear2(self.relu2(self.linear1(self.relu1(skips))))
     preds = linear.permute(0,2,1)
     return preds
 
+  def step(self, inputs, queues, t):
+    """
+    inputs:
+      inputs: tensor of size (N,), tokens of timestep t
+      queues: list, ring buffers filled by forward() on timesteps [0, t)
+    outputs:
+      preds: tensor of size (N, vocab_size), prediction for timestep t+1
+    """
+    queues = iter(queues)
+    embedded = self.embedding(inputs)
+    causal = self.causal.step(embedded, queues, t)
+    skips = self.res_stack.step(causal, queues, t)
+    if self.step_linear1 is not None:
+      return self.step_linear2(self.relu2(self.step_linear1(self.relu1(skips))))
+    linear1 = self.linear1.weight[:, :, 0]
+    linear2 = self.linear2.weight[:, :, 0]
+    hidden = F.linear(self.relu1(skips), linear1, self.linear1.bias)
+    preds = F.linear(self.relu2(hidden), linear2, self.linear2.bias)
+    return preds
+
+  def linearize(self):
+    """Gives every convolution an nn.Linear copy used by step(), see CausalConv1d.linearize"""
+    for module in self.modules():
+      if isinstance(module, CausalConv1d):
+        module.linearize()
+    for name in ['linear1', 'linear2']:
+      conv = getattr(self, name)
+      linear = nn.Linear(conv.in_channels, conv.out_channels).to(conv.weight.device)
+      with torch.no_grad():
+        linear.weight.copy_(conv.weight[:, :, 0])
+        linear.bias.copy_(conv.bias)
+      setattr(self, f'step_{name}', linear)
+
 class CNN(nn.Module):
   def __init__(self, cnn, **kwargs):
     super(CNN, self).__init__(**kwargs)
@@ -85,7 +196,28 @@ class CNN(nn.Module):
     
     return loss, preds
         
-  def predict(self, tgt_array, tgt_valid_len):
+  def prime(self, tokens):
+    queues = []
+    return self.cnn(tokens, None, queues)[:, -1], queues
+
+  def step(self, tokens, queues, t):
+    # every token passes each layer once, with per-layer queues of past activations
+    return self.cnn.step(tokens, queues, t), queues
+
+  def select_state(self, queues, index):
+    return [queue[index] for queue in queues]
+
+  def predict(self, tgt_array, tgt_valid_len, prefix_len=None, duration=None, use_cache=True):
+    """
+    tgt_array: tensor of size (N, T), prefixes right-padded to the longest one
+    prefix_len: tensor of size (N,), optional, prefix length of each row
+    duration: tensor of size (N,), optional, seconds of music of each row
+    use_cache: bool, with False every step reruns the network over the whole sequence
+    """
+    if use_cache:
+      return decode(self, tgt_array, tgt_valid_len, prefix_len, duration)
+
+    prefix_len = prefix_lengths(tgt_array, prefix_len)
     N, T = tgt_array.shape
 
     inputs = tgt_array[:, :1]
@@ -93,11 +225,8 @@ class CNN(nn.Module):
 
     for t in range(torch.max(tgt_valid_len)-1):
       o = self.cnn(inputs, tgt_valid_len)
-      if t+1 < T:
-        output = tgt_array[:, t+1:t+2]
-      else:
-        output = o[:,-1:].argmax(dim=-1)
+      output = force_prefix(tgt_array, prefix_len, t+1, o[:,-1:].argmax(dim=-1))
       outputs.append(output)
       inputs = torch.cat(outputs, dim=1)
       
-    return inputs[:, 1:]
+    return limit_duration(inputs[:, 1:], prefix_len, duration)
@@ -0,0 +1,168 @@
+"""
+Greedy autoregressive decoding shared by all the models.
+
+A model takes part by implementing
+  prime(tokens) -> (logits, state)    runs the prefix (N, P) shared by all rows in one pass and
+                                      returns the prediction for position P (N, vocab_size)
+  step(tokens, state, t) -> (logits, state)
+                                      consumes the tokens (N,) of position t and returns the
+                                      prediction for position t+1
+  select_state(state, index) -> state keeps the rows `index` of the batch in state
+The engine owns the token buffer, teacher-forces each row over its own prefix and stops a row once
+it generates eos_token, reaches its own length or, with a duration, once the time_shift events of the
+row add up to it. Finished rows are dropped from the batch, so the remaining steps only run on the
+rows still decoding.
+"""
+import torch
+from model import pad_token, eos_token, prefix_lengths
+from model.prefix_cache import prime
+from processor import START_IDX, RANGE_TIME_SHIFT
+
+# token ids are event ids shifted by the special tokens
+EVENT_OFFSET = 3
+
+
+def time_shift_ticks(tokens):
+  """Hundredths of a second each token moves the timeline by, 0 for tokens other than time_shift"""
+  shift = tokens - (EVENT_OFFSET + START_IDX['time_shift'])
+  is_shift = (shift >= 0) & (shift < RANGE_TIME_SHIFT)
+  return torch.where(is_shift, shift + 1, torch.zeros_like(shift))
+
+
+def duration_ticks(seconds):
+  """Budget in ticks of a duration in seconds, as TokenBuffer and limit_duration compare the elapsed ticks to it"""
+  return float(torch.tensor(seconds, dtype=torch.float32) * 100)
+
+
+def limit_duration(outputs, prefix_len, duration):
+  """
+  Pads every row of decoded outputs (N, S) after the token that brings it to its duration,
+  for decoders that run every row to its length
+  """
+  if duration is None:
+    return outputs
+  # counted in whole ticks so that every decoder stops at the same token
+  elapsed = time_shift_ticks(outputs).cumsum(dim=1)
+  positions = torch.arange(1, outputs.shape[1]+1, device=outputs.device).unsqueeze(0)
+  # from the last prefix token on
+  reached = (elapsed >= duration.unsqueeze(1) * 100) & (positions >= prefix_len.unsqueeze(1) - 1)
+  after = (reached.cumsum(dim=1) - reached.long()) > 0
+  return outputs.masked_fill(after, pad_token)
+
+
+class TokenBuffer:
+  """
+  Tokens of a batch being decoded. Teacher-forces each row over its own prefix and tells when a row
+  is finished: at its eos_token, its length or its duration.
+  """
+
+  def __init__(self, target, valid_len, prefix_len, steps, duration=None):
+    N, T = target.shape
+    self.valid_len = valid_len.to(target.device)
+    positions = torch.arange(steps+1, device=target.device).unsqueeze(0)
+    self.tokens = torch.full((N, steps+1), pad_token, dtype=target.dtype, device=target.device)
+    self.tokens[:, :min(T, steps+1)] = target[:, :steps+1]
+    self.tokens.masked_fill_(positions >= self.valid_len.unsqueeze(1), pad_token)
+    # one more column, a row is only stopped by its duration once past its prefix
+    self.in_prefix = torch.arange(steps+2, device=target.device).unsqueeze(0) < prefix_len.unsqueeze(1)
+    self.budget = None
+    if duration is not None:
+      self.budget = duration.to(target.device) * 100
+      self.elapsed = torch.zeros(N, dtype=torch.long, device=target.device)
+
+  def prime(self, primed):
+    """
+    The first `primed` positions, prefix of every row. Returns the rows finished within them: by their
+    length, or by their duration for the rows whose prefix ends there, as limit_duration does
+    """
+    finished = self.valid_len <= primed
+    if self.budget is not None:
+      self.elapsed += time_shift_ticks(self.tokens[:, 1:primed]).sum(dim=1)
+      finished |= (self.elapsed >= self.budget) & ~self.in_prefix[:, primed]
+    return finished
+
+  def choose(self, rows, pos, logits):
+    """Token of position pos of `rows`: the prefix token, the greedy choice from logits past the prefix"""
+    return torch.where(self.in_prefix[rows, pos], self.tokens[rows, pos], logits.argmax(dim=-1))
+
+  def commit(self, rows, pos, tokens):
+    """Writes the tokens of position pos of `rows`, returns which of them are finished"""
+    self.tokens[rows, pos] = tokens
+    finished = (self.valid_len[rows] <= pos+1) | (~self.in_prefix[rows, pos] & (tokens == eos_token))
+    if self.budget is not None:
+      self.elapsed[rows] += time_shift_ticks(tokens)
+      finished |= (self.elapsed[rows] >= self.budget[rows]) & ~self.in_prefix[rows, pos+1]
+    return finished
+
+  def outputs(self):
+    return self.tokens[:, 1:]
+
+
+def decode(model, target, valid_len, prefix_len=None, duration=None, seeds=None):
+  """
+  inputs:
+    target: tensor of size (N, T), prefixes right-padded to the longest one
+    valid_len: tensor of size (N,), length of each row, prefix included
+    prefix_len: tensor of size (N,), optional, prefix length of each row, T by default
+    duration: tensor of size (N,), optional, seconds of music of each row, inf for no limit
+    seeds: list of N int or None, optional, seeds of the latent noise of models that draw one in prime()
+  outputs:
+    tensor of size (N, max(valid_len)-1), positions 1.. of every row, pad_token after a row's eos_token,
+    after the token that brings it to its duration and past its length
+  """
+  N, T = target.shape
+  prefix_len = prefix_lengths(target, prefix_len)
+  primed = int(torch.min(prefix_len))
+  steps = int(torch.max(valid_len)) - 1
+  if steps < primed:
+    return target[:, 1:steps+1]
+
+  buffer = TokenBuffer(target, valid_len, prefix_len, steps, duration)
+  finished = buffer.prime(primed)
+  if finished.all():
+    return buffer.outputs()
+  logits, state = prime(model, buffer.tokens[:, :primed], seeds)
+  # rows of the buffer still decoding, in the order of the rows of state
+  active = torch.arange(N, device=target.device)
+  for t in range(primed-1, steps):
+    if finished.any():
+      keep = (~finished).nonzero().squeeze(1)
+      if keep.numel() == 0:
+        break
+      active = active[keep]
+      logits = logits[keep]
+      state = model.select_state(state, keep)
+
+    next_tokens = buffer.choose(active, t+1, logits)
+    finished = buffer.commit(active, t+1, next_tokens)
+    if t+1 < steps:
+      logits, state = model.step(next_tokens, state, t+1)
+
+  return buffer.outputs()
+
+
+def decode_segment(model, logits, state, position, length):
+  """
+  Greedy decoding of the `length` positions after `position`, carrying on from the logits and state left
+  by prime() or by the previous segment. Nothing before is recomputed.
+  inputs:
+    logits: tensor of size (N, vocab_size), prediction for position+1
+    state: state of the model after position
+    position: int, last position consumed by the model
+  outputs:
+    tokens (N, <= length), pad_token after a row's eos_token, decoding stops once every row has one
+    logits and state for the next segment, finished rows (N,)
+  """
+  if length <= 0:
+    raise ValueError(f'segment length must be positive, got {length}')
+  N = logits.shape[0]
+  finished = torch.zeros(N, dtype=torch.bool, device=logits.device)
+  tokens = []
+  for t in range(position, position+length):
+    next_tokens = logits.argmax(dim=-1).masked_fill(finished, pad_token)
+    tokens.append(next_tokens)
+    finished |= next_tokens == eos_token
+    if finished.all():
+      break
+    logits, state = model.step(next_tokens, state, t+1)
+  return torch.stack(tokens, dim=1), logits, state, finished
@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from model import device, bos_token, MAX_LEN
+from model import bos_token, MAX_LEN, latent_noise
+from model.decoding import decode
+from model.gru_step import fused_gru_step
 
 class Discriminator(nn.Module):
   def __init__(self, vocab_size, embedding_dim, hidden_size, num_layers, dense_size):
@@ -67,24 +69,27 @@ class Generator(nn.Module):
     preds = torch.cat(preds, dim=1)
     return preds
 
-  def predict(self, target, valid_len):
-    N, T = target.shape
-    h = target.new_zeros(self.num_layers, N, self.hidden_size).float()
-    z = torch.randn(N, self.latent_dim).to(device)
+  def prime(self, tokens, seeds=None):
+    N, T = tokens.shape
+    h = tokens.new_zeros(self.num_layers, N, self.hidden_size).float()
+    z = latent_noise(N, self.latent_dim, seeds)
+    concat = torch.cat((self.embedding(tokens), z.unsqueeze(1).expand(-1, T, -1)), dim=2)
+    o, h = self.rnn(concat, h)
+    # generated tokens go through the precomputed embedding-to-gate table, the z part is computed once
+    latent = fused_gru_step(self, self.embedding, self.rnn).latent(z)
+    return self.fc(o[:, -1]), (h, latent)
 
-    inputs = target[:, :1]
-    preds = []
+  def step(self, tokens, state, t):
+    h, latent = state
+    o, h = fused_gru_step(self, self.embedding, self.rnn)(tokens, h, latent)
+    return self.fc(o), (h, latent)
 
-    for t in range(torch.max(valid_len)-1):
-      inputs_embedded = self.embedding(inputs)
-      concat = torch.cat((inputs_embedded, z.unsqueeze(1)), dim=2)
-      o, h = self.rnn(concat, h)
-      pred = self.fc(o)
-      if t+1 < T:
-        inputs = target[:, t+1:t+2]
-      else:
-        inputs = pred.argmax(dim=-1)
-      preds.append(inputs)
+  def select_state(self, state, index):
+    h, latent = state
+    return h[:, index], latent[index]
 
-    preds = torch.cat(preds, dim=1)
-    return preds
+  def join_states(self, states):
+    return torch.cat([h for h, _ in states], dim=1), torch.cat([latent for _, latent in states])
+
+  def predict(self, target, valid_len, prefix_len=None, duration=None, seeds=None):
+    return decode(self, target, valid_len, prefix_len, duration, seeds)
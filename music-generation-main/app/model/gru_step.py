@@ -0,0 +1,104 @@
+import torch
+import torch.nn.functional as F
+
+
+class FusedGRUStep:
+  """
+  Inference-only single decoding step of an nn.Embedding followed by a multi-layer nn.GRU.
+
+  The vocabulary is small, so the input projection of the first GRU layer is precomputed for every
+  token into a (vocab_size, 3*hidden_size) table and a step only gathers rows of it. Inputs that
+  concatenate a latent vector to the embedding split the projection, the latent part is computed
+  once per sequence with latent().
+  It is built from the modules of a loaded model and reads their weights, it is not a submodule.
+  """
+  def __init__(self, embedding, rnn):
+    self.embedding = embedding
+    self.rnn = rnn
+    self.num_layers = rnn.num_layers
+    self.embedding_dim = embedding.embedding_dim
+    self._versions = None
+    self._build()
+
+  def _weight_versions(self):
+    return (self.embedding.weight._version, self.rnn.weight_ih_l0._version, self.rnn.bias_ih_l0._version)
+
+  def _build(self):
+    with torch.no_grad():
+      w_ih = self.rnn.weight_ih_l0[:, :self.embedding_dim]
+      self.table = F.linear(self.embedding.weight, w_ih, self.rnn.bias_ih_l0)
+    self._versions = self._weight_versions()
+
+  @property
+  def stale(self):
+    """True once the embedding or the first layer input weights were modified in place"""
+    return self._versions != self._weight_versions()
+
+  def latent(self, z):
+    """
+    inputs:
+      z: tensor of size (N, latent_dim), concatenated after the embedding at every step
+    outputs:
+      tensor of size (N, 3*hidden_size), its share of the first layer input projection
+    """
+    return F.linear(z, self.rnn.weight_ih_l0[:, self.embedding_dim:])
+
+  def __call__(self, tokens, h, latent=None):
+    """
+    inputs:
+      tokens: tensor of size (N,)
+      h: tensor of size (num_layers, N, hidden_size)
+      latent: tensor of size (N, 3*hidden_size), optional, from latent()
+    outputs:
+      o: tensor of size (N, hidden_size), output of the last layer
+      h: tensor of size (num_layers, N, hidden_size)
+    """
+    gi = self.table[tokens]
+    if latent is not None:
+      gi = gi + latent
+
+    hs = []
+    for l in range(self.num_layers):
+      if l > 0:
+        gi = F.linear(x, getattr(self.rnn, f'weight_ih_l{l}'), getattr(self.rnn, f'bias_ih_l{l}'))
+      gh = F.linear(h[l], getattr(self.rnn, f'weight_hh_l{l}'), getattr(self.rnn, f'bias_hh_l{l}'))
+      i_r, i_z, i_n = gi.chunk(3, dim=1)
+      h_r, h_z, h_n = gh.chunk(3, dim=1)
+      r = torch.sigmoid(i_r + h_r)
+      z = torch.sigmoid(i_z + h_z)
+      n = torch.tanh(i_n + r * h_n)
+      x = n + z * (h[l] - n)
+      hs.append(x)
+    return x, torch.stack(hs)
+
+
+class GRUStep:
+  """
+  Single decoding step through the modules themselves, with the same interface as FusedGRUStep.
+  Used for GRUs whose weights are not plain tensors, e.g. dynamically quantized ones.
+  """
+  def __init__(self, embedding, rnn):
+    self.embedding = embedding
+    self.rnn = rnn
+    self.stale = False
+
+  def latent(self, z):
+    return z
+
+  def __call__(self, tokens, h, latent=None):
+    inputs = self.embedding(tokens)
+    if latent is not None:
+      inputs = torch.cat((inputs, latent), dim=1)
+    o, h = self.rnn(inputs.unsqueeze(1), h)
+    return o[:, 0], h
+
+
+def fused_gru_step(model, embedding, rnn):
+  """FusedGRUStep of `model`, kept on the model and rebuilt when its weights change"""
+  if not hasattr(rnn, 'weight_ih_l0'):
+    return GRUStep(embedding, rnn)
+  step = getattr(model, '_gru_step', None)
+  if step is None or step.rnn is not rnn or step.embedding is not embedding or step.stale:
+    step = FusedGRUStep(embedding, rnn)
+    model._gru_step = step
+  return step
@@ -0,0 +1,182 @@
+"""
+Per-model cache of the state reached after a token prefix, so that a request resumes from the longest
+prefix seen before instead of running it again.
+
+Prefixes are kept in a trie, one per latent seed (None for models without a latent). A cached entry
+holds the prediction for the next position and the state of one row. Besides the decoding.decode
+protocol the model implements
+  join_states(states) -> state   the batch of the single-row states, all at the same position, in new
+                                 containers and tensors
+and select_state() returns a state that does not share mutable containers with the one it was given.
+
+A resumed row steps over the rest of its prefix and is joined with the others, which runs other
+kernels than priming the whole batch in one pass: its logits match a cold prime up to float rounding,
+not bit for bit, so a greedy choice between two near-equal logits can differ.
+"""
+import threading
+import torch
+
+
+def state_size(state):
+  """Bytes of the tensors held by a state"""
+  if torch.is_tensor(state):
+    return state.numel() * state.element_size()
+  if isinstance(state, dict):
+    return sum(state_size(value) for value in state.values())
+  if isinstance(state, (list, tuple)):
+    return sum(state_size(value) for value in state)
+  return 0
+
+
+class _Node:
+  __slots__ = ('parent', 'token', 'children', 'entry')
+
+  def __init__(self, parent=None, token=None):
+    self.parent = parent
+    self.token = token
+    self.children = {}
+    # (logits, state, size) when the prefix ending here is cached
+    self.entry = None
+
+
+class PrefixCache:
+  """States of token prefixes of one model, least recently used ones dropped past `budget` bytes"""
+
+  def __init__(self, budget):
+    self.budget = budget
+    self.size = 0
+    self._roots = {}
+    # cached nodes in LRU order
+    self._lru = {}
+    self._lock = threading.Lock()
+    self.lookups = 0
+    self.hits = 0
+    self.reused_tokens = 0
+    self.primed_tokens = 0
+
+  def _longest(self, root, tokens):
+    node, found, length = root, None, 0
+    for i, token in enumerate(tokens):
+      node = node.children.get(token)
+      if node is None:
+        break
+      if node.entry is not None:
+        found, length = node, i+1
+    return found, length
+
+  def _insert(self, root, tokens, logits, state):
+    size = state_size(state) + state_size(logits)
+    if size > self.budget:
+      return
+    node = root
+    for token in tokens:
+      node = node.children.setdefault(token, _Node(node, token))
+    if node.entry is not None:
+      return
+    node.entry = (logits, state, size)
+    self._lru[node] = None
+    self.size += size
+    while self.size > self.budget:
+      self._drop(next(iter(self._lru)))
+
+  def _drop(self, node):
+    del self._lru[node]
+    self.size -= node.entry[2]
+    node.entry = None
+    # prune the branch that no longer leads to a cached prefix
+    while node.parent is not None and node.entry is None and not node.children:
+      del node.parent.children[node.token]
+      node = node.parent
+
+  def _touch(self, node):
+    del self._lru[node]
+    self._lru[node] = None
+
+  def prime(self, model, tokens, seeds=None):
+    """
+    model.prime(tokens, seeds), each row resumed from the longest cached prefix of it. Rows of models
+    with a latent are only cached with a seed. A model attending to a window is primed over the whole
+    prefix but steps over the window only, so resuming it would not give the same state.
+    """
+    if getattr(model, 'window', None) is not None:
+      return model.prime(tokens) if seeds is None else model.prime(tokens, seeds)
+    N, P = tokens.shape
+    latent = hasattr(model, 'latent_dim')
+    keys = [(seeds[i] if seeds is not None else None) for i in range(N)]
+    rows = tokens.tolist()
+    found = []
+    with self._lock:
+      for i in range(N):
+        cacheable = not latent or keys[i] is not None
+        root = self._roots.setdefault(keys[i], _Node()) if cacheable else None
+        node, length = self._longest(root, rows[i]) if cacheable else (None, 0)
+        if node is not None:
+          self._touch(node)
+          logits, state, _ = node.entry
+          # a row resumed within its prefix steps on a copy, a whole-prefix hit only goes through join_states
+          if length < P:
+            state = model.select_state(state, torch.tensor([0], device=tokens.device))
+          found.append((length, logits, state))
+        else:
+          found.append((0, None, None))
+        self.lookups += 1
+        self.hits += node is not None
+        self.reused_tokens += length
+        self.primed_tokens += P
+
+    # rows without any cached prefix are primed together
+    missed = [i for i in range(N) if found[i][0] == 0]
+    if missed:
+      index = torch.tensor(missed, device=tokens.device)
+      if seeds is None:
+        logits, state = model.prime(tokens[index])
+      else:
+        logits, state = model.prime(tokens[index], [seeds[i] for i in missed])
+      if len(missed) == N:
+        self._insert_rows(model, rows, keys, logits, state)
+        return logits, state
+      for j, i in enumerate(missed):
+        found[i] = (P, logits[j:j+1], model.select_state(state, torch.tensor([j], device=tokens.device)))
+
+    results = []
+    for i, (length, logits, state) in enumerate(found):
+      for t in range(length, P):
+        logits, state = model.step(tokens[i, t:t+1], state, t)
+      results.append((logits, state))
+
+    logits = torch.cat([logits for logits, _ in results])
+    state = model.join_states([state for _, state in results])
+    # whole-prefix hits are cached already
+    self._insert_rows(model, rows, keys, logits, state, [length < P for length, _, _ in found])
+    return logits, state
+
+  def _insert_rows(self, model, rows, keys, logits, state, new=None):
+    with self._lock:
+      for i in range(len(rows)):
+        # rows of models with a latent and no seed were not looked up
+        if keys[i] in self._roots and (new is None or new[i]):
+          index = torch.tensor([i], device=logits.device)
+          self._insert(self._roots[keys[i]], rows[i], logits[index], model.select_state(state, index))
+
+  def stats(self):
+    with self._lock:
+      return {
+        "lookups": self.lookups,
+        "hits": self.hits,
+        "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+        "reused_tokens": self.reused_tokens,
+        "token_hit_rate": self.reused_tokens / self.primed_tokens if self.primed_tokens else 0.0,
+        "entries": len(self._lru),
+        "bytes": self.size,
+        "budget": self.budget,
+      }
+
+
+def prime(model, tokens, seeds=None):
+  """model.prime() through the prefix cache of the model when it has one"""
+  cache = getattr(model, 'prefix_cache', None)
+  if cache is not None:
+    return cache.prime(model, tokens, seeds)
+  if seeds is None:
+    return model.prime(tokens)
+  return model.prime(tokens, seeds)
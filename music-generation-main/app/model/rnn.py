@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from model import pad_token
+from model.decoding import decode
+from model.gru_step import fused_gru_step
 
 
 class RNN(nn.Module):
@@ -40,22 +42,26 @@ class RNN(nn.Module):
         # preds (B, T) (32, 600)
         return loss, preds
 
-    def predict(self, target, valid_len):
-        N, T = target.shape
-        h = target.new_zeros(self.num_layers, N, self.hidden_size).float()
+    def prime(self, tokens):
+        h = tokens.new_zeros(self.num_layers, tokens.shape[0], self.hidden_size).float()
+        o, h = self.rnn(self.embedding(tokens), h)
+        return self.fc(o[:, -1]), h
 
-        inputs = target[:, :1]
-        preds = []
+    def step(self, tokens, h, t):
+        # generated tokens go through the precomputed embedding-to-gate table
+        o, h = fused_gru_step(self, self.embedding, self.rnn)(tokens, h)
+        return self.fc(o), h
+
+    def select_state(self, h, index):
+        return h[:, index]
 
-        for t in range(torch.max(valid_len) - 1):
-            inputs_embedded = self.embedding(inputs)
-            o, h = self.rnn(inputs_embedded, h)
-            if t + 1 < T:
-                inputs = target[:, t + 1:t + 2]
-            else:
-                pred = self.fc(o)
-                inputs = pred.argmax(dim=-1)
-            preds.append(inputs)
-
-        preds = torch.cat(preds, dim=1)
-        return preds
+    def join_states(self, states):
+        return torch.cat(states, dim=1)
+
+    def predict(self, target, valid_len, prefix_len=None, duration=None):
+        """
+        target: tensor of size (N, T), prefixes right-padded to the longest one
+        prefix_len: tensor of size (N,), optional, prefix length of each row
+        duration: tensor of size (N,), optional, seconds of music of each row
+        """
+        return decode(self, target, valid_len, prefix_len, duration)
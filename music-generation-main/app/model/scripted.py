@@ -0,0 +1,275 @@
+"""
+TorchScript-friendly greedy decoders for the five models.
+
+Each decoder wraps the submodules of a loaded model (so it shares its weights) and implements the
+whole decode loop, prefix priming included, in forward(target, valid_len, prefix_len). Only
+built-in torch modules are called, so torch.jit.script never has to compile the training code.
+"""
+from typing import List, Optional
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _force_prefix(target, prefix_len, pos: int, generated):
+  if pos >= target.size(1):
+    return generated
+  return torch.where(prefix_len > pos, target[:, pos], generated)
+
+
+class GRUDecoder(nn.Module):
+  """Decoder of an embedding + nn.GRU + linear model: RNN, VAE decoder and GAN generator"""
+  def __init__(self, embedding, rnn, fc, latent_dim: int = 0):
+    super(GRUDecoder, self).__init__()
+    self.embedding = embedding
+    self.rnn = rnn
+    self.fc = fc
+    self.latent_dim = latent_dim
+    self.num_layers = rnn.num_layers
+    self.hidden_size = rnn.hidden_size
+
+  def _inputs(self, tokens, z):
+    embedded = self.embedding(tokens)
+    if self.latent_dim > 0:
+      embedded = torch.cat((embedded, z.unsqueeze(1).expand(-1, tokens.size(1), -1)), dim=2)
+    return embedded
+
+  def forward(self, target, valid_len, prefix_len, z: Optional[torch.Tensor] = None):
+    N = target.size(0)
+    h = torch.zeros(self.num_layers, N, self.hidden_size, device=target.device)
+    if z is None:
+      z = torch.randn(N, self.latent_dim, device=target.device)
+
+    primed = int(prefix_len.min())
+    steps = int(valid_len.max()) - 1
+    if steps < primed:
+      return target[:, 1:steps+1]
+
+    o, h = self.rnn(self._inputs(target[:, :primed], z), h)
+    pred = self.fc(o[:, -1])
+    preds = torch.empty((N, steps), dtype=target.dtype, device=target.device)
+    preds[:, :primed-1] = target[:, 1:primed]
+
+    for t in range(primed-1, steps):
+      token = _force_prefix(target, prefix_len, t+1, pred.argmax(dim=-1))
+      preds[:, t] = token
+      if t+1 < steps:
+        o, h = self.rnn(self._inputs(token.unsqueeze(1), z), h)
+        pred = self.fc(o[:, 0])
+    return preds
+
+
+class _DecoderBlock(nn.Module):
+  def __init__(self, block):
+    super(_DecoderBlock, self).__init__()
+    attention = block.attention
+    self.num_heads = attention.num_heads
+    self.W_q = attention.W_q
+    self.W_k = attention.W_k
+    self.W_v = attention.W_v
+    self.W_o = attention.W_o
+    self.norm_1 = block.addnorm_1.norm
+    self.ffn_l1 = block.ffn.ffn_l1
+    self.ffn_l2 = block.ffn.ffn_l2
+    self.norm_2 = block.addnorm_2.norm
+
+  def forward(self, X, key, value, mask):
+    """
+    X: tensor of size (N, T, d_model), new positions
+    key, value: tensors of size (N, S, num_heads * d_k), cached and new positions
+    mask: tensor of size (T, S), True where a position may not be attended
+    """
+    N, T, _ = X.shape
+    S = key.size(1)
+    query = self.W_q(X)
+    d_k = query.size(2) // self.num_heads
+    query = query.reshape(N, T, self.num_heads, d_k).permute(0, 2, 1, 3)
+    key = key.reshape(N, S, self.num_heads, d_k).permute(0, 2, 1, 3)
+    value = value.reshape(N, S, self.num_heads, d_k).permute(0, 2, 1, 3)
+    scores = torch.matmul(query, key.transpose(2, 3)) / (d_k ** 0.5)
+    scores = scores.masked_fill(mask, -1e7)
+    attention = torch.matmul(torch.softmax(scores, dim=-1), value)
+    attention = self.W_o(attention.permute(0, 2, 1, 3).reshape(N, T, -1))
+    X = self.norm_1(attention + X)
+    return self.norm_2(self.ffn_l2(torch.relu(self.ffn_l1(X))) + X)
+
+
+class TransformerDecoderLoop(nn.Module):
+  """Decoder of the Transformer with per-layer key/value caches"""
+  def __init__(self, decoder, window: Optional[int] = None):
+    super(TransformerDecoderLoop, self).__init__()
+    self.d_model = decoder.d_model
+    self.max_len = decoder.pos_enc.max_len
+    # 0 attends over the whole history
+    self.window = window if window is not None else 0
+    self.embedding = decoder.embedding
+    self.blocks = nn.ModuleList([_DecoderBlock(block) for block in decoder.layers])
+    self.dense = decoder.dense
+    self.register_buffer('div', torch.pow(10000, torch.arange(0, self.d_model, 2, dtype=torch.float32) / self.d_model))
+
+  def _positions(self, past: int, T: int):
+    X = torch.arange(past, past+T, dtype=torch.float32, device=self.div.device).reshape(-1, 1) / self.div
+    pe = torch.zeros((T, self.d_model), device=self.div.device)
+    pe[:, 0::2] = torch.sin(X)
+    pe[:, 1::2] = torch.cos(X)
+    return pe
+
+  def _decode(self, tokens, keys: List[torch.Tensor], values: List[torch.Tensor], past: int):
+    T = tokens.size(1)
+    X = self.embedding(tokens) * (self.d_model ** 0.5) + self._positions(past, T).unsqueeze(0)
+    cached = keys[0].size(1) if past > 0 else 0
+    positions = torch.arange(cached+T, device=tokens.device)
+    mask = positions.unsqueeze(0) > positions[cached:].unsqueeze(1)
+    for i, block in enumerate(self.blocks):
+      key = block.W_k(X)
+      value = block.W_v(X)
+      if past > 0:
+        key = torch.cat((keys[i], key), dim=1)
+        value = torch.cat((values[i], value), dim=1)
+      X = block(X, key, value, mask)
+      if self.window > 0:
+        key = key[:, -self.window:]
+        value = value[:, -self.window:]
+      keys[i] = key
+      values[i] = value
+    return self.dense(X[:, -1])
+
+  def forward(self, target, valid_len, prefix_len):
+    N = target.size(0)
+    primed = int(prefix_len.min())
+    steps = int(valid_len.max()) - 1
+    if steps < primed:
+      return target[:, 1:steps+1]
+    if self.window == 0 and steps > self.max_len:
+      raise ValueError('sequence is longer than the positional encoding')
+
+    empty = torch.empty(0, device=target.device)
+    keys = [empty for _ in range(len(self.blocks))]
+    values = [empty for _ in range(len(self.blocks))]
+    pred = self._decode(target[:, :primed], keys, values, 0)
+    preds = torch.empty((N, steps), dtype=target.dtype, device=target.device)
+    preds[:, :primed-1] = target[:, 1:primed]
+
+    for t in range(primed-1, steps):
+      token = _force_prefix(target, prefix_len, t+1, pred.argmax(dim=-1))
+      preds[:, t] = token
+      if t+1 < steps:
+        pred = self._decode(token.unsqueeze(1), keys, values, t+1)
+    return preds
+
+
+class _CausalConv(nn.Module):
+  def __init__(self, causal_conv):
+    super(_CausalConv, self).__init__()
+    conv = causal_conv.conv1d
+    self.conv = conv
+    self.padding = causal_conv.padding
+    self.kernel_size = conv.kernel_size[0]
+    self.dilation = conv.dilation[0]
+    # kernel laid out over the concatenated taps, oldest first, for step()
+    self.register_buffer('step_weight', conv.weight.detach().permute(0, 2, 1).reshape(conv.weight.size(0), -1).clone())
+
+  def prime(self, inputs):
+    """Output for the whole sequence and the ring buffer of its last `padding` inputs"""
+    out = self.conv(inputs)[:, :, :-self.padding]
+    past = F.pad(inputs, (self.padding, 0))[:, :, -self.padding:]
+    return out, past.roll(inputs.size(2) % self.padding, dims=2).contiguous()
+
+  def step(self, inputs, queue, t: int):
+    taps: List[torch.Tensor] = []
+    for j in range(self.kernel_size-1):
+      taps.append(queue[:, :, (t - (self.kernel_size-1-j) * self.dilation) % self.padding])
+    taps.append(inputs)
+    out = F.linear(torch.cat(taps, dim=1), self.step_weight, self.conv.bias)
+    queue[:, :, t % self.padding] = inputs
+    return out
+
+
+class _ResBlock(nn.Module):
+  def __init__(self, res_block):
+    super(_ResBlock, self).__init__()
+    self.res_channels = res_block.res_channels
+    self.dilated = _CausalConv(res_block.conv_dilated)
+    self.res = res_block.conv_res.conv1d
+    self.skip = res_block.conv_skip.conv1d
+
+  def _gate(self, dilated):
+    return torch.tanh(dilated[:, :self.res_channels]) * torch.sigmoid(dilated[:, self.res_channels:])
+
+  def prime(self, inputs):
+    dilated, queue = self.dilated.prime(inputs)
+    gated = self._gate(dilated)
+    return self.res(gated) + inputs, self.skip(gated), queue
+
+  def step(self, inputs, queue, t: int):
+    gated = self._gate(self.dilated.step(inputs, queue, t))
+    out = F.linear(gated, self.res.weight[:, :, 0], self.res.bias) + inputs
+    skip = F.linear(gated, self.skip.weight[:, :, 0], self.skip.bias)
+    return out, skip
+
+
+class WaveNetDecoderLoop(nn.Module):
+  """Decoder of the CNN with Fast WaveNet ring buffers"""
+  def __init__(self, wave_net):
+    super(WaveNetDecoderLoop, self).__init__()
+    self.embedding = wave_net.embedding
+    self.causal = _CausalConv(wave_net.causal)
+    self.blocks = nn.ModuleList([_ResBlock(block) for block in wave_net.res_stack.res_blocks])
+    self.linear1 = wave_net.linear1
+    self.linear2 = wave_net.linear2
+
+  def _output(self, skips):
+    hidden = F.linear(torch.relu(skips), self.linear1.weight[:, :, 0], self.linear1.bias)
+    return F.linear(torch.relu(hidden), self.linear2.weight[:, :, 0], self.linear2.bias)
+
+  def _prime(self, tokens, queues: List[torch.Tensor]):
+    out, queue = self.causal.prime(self.embedding(tokens).permute(0, 2, 1))
+    queues.append(queue)
+    skips = torch.zeros(0)
+    for i, block in enumerate(self.blocks):
+      out, skip, queue = block.prime(out)
+      queues.append(queue)
+      skips = skip if i == 0 else skips + skip
+    return self._output(skips[:, :, -1])
+
+  def _step(self, tokens, queues: List[torch.Tensor], t: int):
+    out = self.causal.step(self.embedding(tokens), queues[0], t)
+    skips = torch.zeros(0)
+    for i, block in enumerate(self.blocks):
+      out, skip = block.step(out, queues[i+1], t)
+      skips = skip if i == 0 else skips + skip
+    return self._output(skips)
+
+  def forward(self, target, valid_len, prefix_len):
+    N = target.size(0)
+    primed = int(prefix_len.min())
+    steps = int(valid_len.max()) - 1
+    if steps < primed:
+      return target[:, 1:steps+1]
+
+    queues: List[torch.Tensor] = []
+    pred = self._prime(target[:, :primed], queues)
+    preds = torch.empty((N, steps), dtype=target.dtype, device=target.device)
+    preds[:, :primed-1] = target[:, 1:primed]
+
+    for t in range(primed-1, steps):
+      token = _force_prefix(target, prefix_len, t+1, pred.argmax(dim=-1))
+      preds[:, t] = token
+      if t+1 < steps:
+        pred = self._step(token, queues, t+1)
+    return preds
+
+
+def script_decoder(name, model):
+  """Scriptable decoder of the loaded model `name`, sharing its weights"""
+  if name == 'rnn':
+    return GRUDecoder(model.embedding, model.rnn, model.fc)
+  if name == 'vae':
+    return GRUDecoder(model.decoder.embedding, model.decoder.rnn, model.decoder.fc, model.latent_dim)
+  if name == 'gan':
+    return GRUDecoder(model.embedding, model.rnn, model.fc, model.latent_dim)
+  if name == 'transformer':
+    return TransformerDecoderLoop(model.decoder, model.window)
+  if name == 'cnn':
+    return WaveNetDecoderLoop(model.cnn)
+  raise ValueError(f'unknown model {name}')
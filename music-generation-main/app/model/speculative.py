@@ -0,0 +1,134 @@
+"""
+Speculative greedy decoding: a cheap draft model proposes the next k tokens, the model verifies all of
+them in one pass and keeps the longest run that matches its own greedy choices, plus its own choice
+at the first mismatch. The output is the one of decoding.decode with the model alone.
+
+The draft implements the decoding.decode protocol, its select_state() returning a copy that later
+steps do not update. The verifying model also implements
+  extend(tokens, state) -> (logits, state)  consumes the tokens (N, k) of the next k positions and
+                                            returns the prediction after each of them (N, k, vocab_size)
+  rewind(state, length) -> state            forgets the positions from `length` on
+"""
+import torch
+from model import prefix_lengths
+from model.decoding import TokenBuffer
+from model.prefix_cache import prime
+
+
+class SpeculativeModel:
+  """predict() of `model` with the tokens drafted `k` at a time by `draft`"""
+
+  def __init__(self, model, draft, k=4):
+    self.model = model
+    self.draft = draft
+    self.k = k
+    self.proposed = 0
+    self.accepted = 0
+
+  @property
+  def window(self):
+    return getattr(self.model, 'window', None)
+
+  # stepping one token at a time, for segments and streams, has nothing to draft: it is the model's own
+  def prime(self, tokens):
+    return prime(self.model, tokens)
+
+  def step(self, tokens, state, t):
+    return self.model.step(tokens, state, t)
+
+  def select_state(self, state, index):
+    return self.model.select_state(state, index)
+
+  def join_states(self, states):
+    return self.model.join_states(states)
+
+  @property
+  def acceptance_rate(self):
+    return self.accepted / self.proposed if self.proposed else 0.0
+
+  def predict(self, target, valid_len, prefix_len=None, duration=None):
+    outputs, proposed, accepted = speculative_decode(self.model, self.draft, target, valid_len, prefix_len,
+                                                     duration, self.k)
+    self.proposed += proposed
+    self.accepted += accepted
+    return outputs
+
+  def eval(self):
+    self.model.eval()
+    self.draft.eval()
+    return self
+
+
+def speculative_decode(model, draft, target, valid_len, prefix_len=None, duration=None, k=4):
+  """
+  inputs:
+    the ones of decoding.decode
+    k: int, number of tokens drafted per verification pass
+  outputs:
+    outputs of decoding.decode, number of drafted tokens, number of them committed
+  """
+  N, T = target.shape
+  prefix_len = prefix_lengths(target, prefix_len)
+  primed = int(torch.min(prefix_len))
+  steps = int(torch.max(valid_len)) - 1
+  if steps < primed:
+    return target[:, 1:steps+1], 0, 0
+
+  buffer = TokenBuffer(target, valid_len, prefix_len, steps, duration)
+  logits, state = prime(model, buffer.tokens[:, :primed])
+  _, draft_state = prime(draft, buffer.tokens[:, :primed])
+  finished = buffer.prime(primed)
+  active = torch.arange(N, device=target.device)
+  # both models have consumed the positions before pos, the token of pos is decided
+  pos = primed
+  live = (~finished).nonzero().squeeze(1)
+  finished[live] = buffer.commit(live, pos, buffer.choose(live, pos, logits[live]))
+  proposed = accepted = 0
+
+  while pos < steps:
+    if finished.any():
+      keep = (~finished).nonzero().squeeze(1)
+      if keep.numel() == 0:
+        break
+      active = active[keep]
+      state = model.select_state(state, keep)
+      draft_state = draft.select_state(draft_state, keep)
+    n_draft = min(k, steps - pos - 1)
+
+    # draft positions pos+1..pos+n_draft, keeping a copy of the draft state after each token: step()
+    # may update a state in place, as the CNN ring buffers are
+    rows = torch.arange(len(active), device=target.device)
+    tokens = buffer.tokens[active, pos]
+    draft_states = []
+    drafted = []
+    for j in range(n_draft):
+      draft_logits, draft_state = draft.step(tokens, draft_state, pos+j)
+      draft_states.append(draft.select_state(draft_state, rows))
+      tokens = buffer.choose(active, pos+j+1, draft_logits)
+      drafted.append(tokens)
+
+    # the prediction of the model for positions pos+1..pos+n_draft+1
+    block = torch.stack([buffer.tokens[active, pos]] + drafted, dim=1)
+    logits, state = model.extend(block, state)
+    expected = torch.stack([buffer.choose(active, pos+j+1, logits[:, j]) for j in range(n_draft+1)], dim=1)
+
+    # the run of drafted tokens accepted by every row
+    matches = (expected[:, :n_draft] == block[:, 1:]).long().cumprod(dim=1).sum(dim=1)
+    n = int(matches.min()) if n_draft else 0
+    proposed += n_draft * len(active)
+
+    # positions pos+1..pos+n+1 are decided, the last one by the model; accepted counts the drafted
+    # tokens committed, not the longer runs some rows matched
+    finished = torch.zeros(len(active), dtype=torch.bool, device=target.device)
+    for j in range(n+1):
+      live = (~finished).nonzero().squeeze(1)
+      accepted += len(live) if j < n else 0
+      finished[live] = buffer.commit(active[live], pos+j+1, expected[live, j])
+    state = model.rewind(state, pos+n+1)
+    if n == n_draft:
+      _, draft_state = draft.step(block[:, -1], draft_state, pos+n)
+    else:
+      draft_state = draft_states[n]
+    pos += n+1
+
+  return buffer.outputs(), proposed, accepted
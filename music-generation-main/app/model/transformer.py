@@ -1,7 +1,18 @@
+import os
+import threading
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from model import device, pad_token
+from model import device, pad_token, prefix_lengths, force_prefix
+from model.decoding import decode, limit_duration
+
+PE_CHUNK_SIZE = int(os.environ.get("PE_CHUNK_SIZE", 1024))
+# positions of the encoding a model attending over the whole piece can reach
+MAX_POSITIONS = 100000
+
+# process-wide positional encoding tables, key: (dim, device)
+_pe_tables = {}
+_pe_lock = threading.Lock()
 
 def masked_softmax(X, valid_length):
   """
@@ -70,13 +81,15 @@ class MultiHeadAttention(nn.Module):
     self.W_v = nn.Linear(d_model, num_heads * d_k)
     self.W_o = nn.Linear(num_heads * d_k, d_model)
 
-  def forward(self, query, key, value, valid_length):
+  def forward(self, query, key, value, valid_length, cache=None):
     """
     inputs:
       query: tensor of size (B, T, d_model)
       key: tensor of size (B, T, d_model)
       value: tensor of size (B, T, d_model)
       valid_length: (B, )
+      cache: dict, optional, projected keys/values of the previous steps. The projections
+        of the new key/value are appended to it, so only new positions are projected.
 
       B is the batch_size, T is length of sequence, d_model is the feature dimensions of query,
       key, and value.
@@ -91,6 +104,12 @@ class MultiHeadAttention(nn.Module):
     value = self.W_v(value)
     # value (B, T, num_heads * d_k)
 
+    if cache is not None:
+      if 'key' in cache:
+        key = torch.cat((cache['key'], key), dim=1)
+        value = torch.cat((cache['value'], value), dim=1)
+      cache['key'], cache['value'] = key, value
+
     B, T, num_hiddens = key.shape
     _, T_q, _ = query.shape
     d_k = num_hiddens // self.num_heads
@@ -136,28 +155,58 @@ class PositionWiseFFN(nn.Module):
     o = self.ffn_l2(self.relu(self.ffn_l1(X)))
     return o
 
+def _sinusoid_table(dim, length, device, start=0):
+  pe = torch.zeros((1, length, dim), device=device)
+  X = torch.arange(start, start+length, dtype=torch.float32).reshape(-1, 1) / torch.pow(10000, torch.arange(0, dim, 2, dtype=torch.float32) / dim)
+  pe[:, :, 0::2] = torch.sin(X)
+  pe[:, :, 1::2] = torch.cos(X)
+  return pe
+
+def positional_table(dim, device, length):
+  """
+  Sinusoid table of size (1, >= length, dim) shared by every PositionalEncoding of the process.
+  It is grown in chunks of PE_CHUNK_SIZE positions when a longer one is asked for. Each inference
+  worker builds its own on first use.
+  """
+  key = (dim, str(device))
+  pe = _pe_tables.get(key)
+  if pe is None or pe.shape[1] < length:
+    with _pe_lock:
+      pe = _pe_tables.get(key)
+      if pe is None or pe.shape[1] < length:
+        size = -(-length // PE_CHUNK_SIZE) * PE_CHUNK_SIZE
+        pe = _sinusoid_table(dim, size, device)
+        _pe_tables[key] = pe
+  return pe
+
 class PositionalEncoding(nn.Module):
-  def __init__(self, dim, device, max_len=100000):
+  def __init__(self, dim, device, max_len=MAX_POSITIONS):
     super(PositionalEncoding, self).__init__()
     """
     Inputs:
       dim: feature dimension of the positional encoding
+      max_len: maximum number of positions
     """
-    self.pe = torch.zeros((1, max_len, dim), device=device)
-    X = torch.arange(max_len, dtype=torch.float32).reshape(-1, 1) / torch.pow(10000, torch.arange(0, dim, 2, dtype=torch.float32) / dim)
-    self.pe[:, :, 0::2] = torch.sin(X)
-    self.pe[:, :, 1::2] = torch.cos(X)
+    self.dim = dim
+    self.max_len = max_len
 
-
-  def forward(self, X):
+  def forward(self, X, offset=0, shared=True):
     """
     Inputs:
       X: tensor of size (N, T, D_in)
+      offset: int, position of the first element of X
+      shared: bool, with False the encoding of the T positions is computed on its own instead of being
+        read from the shared table, which would have to grow up to offset+T
     Output:
       Y: tensor of the same size of X
     """
     N, T, D_in = X.shape
-    Y = X + self.pe[:, :T, :]
+    if not shared:
+      return X + _sinusoid_table(self.dim, T, X.device, offset)
+    if offset+T > self.max_len:
+      raise ValueError(f'position {offset+T} is out of the {self.max_len} positions of the encoding')
+    pe = positional_table(self.dim, X.device, offset+T)
+    Y = X + pe[:, offset:offset+T, :]
 
     return Y
 
@@ -189,22 +238,19 @@ class DecoderBlock(nn.Module):
     self.ffn = PositionWiseFFN(d_model, ffn_l1_size, ffn_l2_size)
     self.addnorm_2 = AddNorm(dropout, d_model)
 
-  def forward(self, X, valid_len):
+  def forward(self, X, valid_len, cache=None):
     """
     Inputs:
       X: tensor of size (N, T, D), embedded input sequences
-      **kwargs: other arguments you think is necessary for implementation
+      cache: dict, optional, keys/values of the previously decoded positions of this block
     Outputs:
       Y: tensor of size (N, T, D_out)
-      
-      Feel free to output variables if necessary.
     """
     N, T, D = X.shape
-    if self.training:
-      dec_valid_len = torch.arange(1, T+1).repeat(N, 1).to(device)
-    else:
-      dec_valid_len = torch.full((N,), T).to(device)
-    X = self.addnorm_1(X, self.attention(X, X, X, dec_valid_len))
+    past = cache['key'].shape[1] if cache else 0
+    # causal mask: position t attends to positions [0, t], the same as in training
+    dec_valid_len = torch.arange(past+1, past+T+1).repeat(N, 1).to(device)
+    X = self.addnorm_1(X, self.attention(X, X, X, dec_valid_len, cache))
     Y = self.addnorm_2(X, self.ffn(X))
 
     return Y
@@ -229,24 +275,49 @@ class TransformerDecoder(nn.Module):
     self.dense = nn.Linear(d_model, vocab_size)
 
 
-  def forward(self, X, valid_len):
+  def init_cache(self):
+    """Empty per-layer key/value cache for incremental decoding"""
+    return [{} for _ in self.layers]
+
+  def evict(self, cache, window):
+    """Keeps the keys/values of the last `window` positions of the cache"""
+    for layer_cache in cache:
+      evicted = layer_cache['key'].shape[1] - window
+      if evicted > 0:
+        layer_cache['key'] = layer_cache['key'][:, evicted:]
+        layer_cache['value'] = layer_cache['value'][:, evicted:]
+        layer_cache['evicted'] = layer_cache.get('evicted', 0) + evicted
+    return cache
+
+  def forward(self, X, valid_len, cache=None):
     """
     Inputs:
       X: tensor of size (N, T, D), embedded input sequences
       valid_length: tensor of size (N,), valid lengths for each sequence
+      cache: list of dict, optional, from init_cache(). X then holds only the new positions,
+        which are appended to the cache.
     """
-    X = self.pos_enc(self.embedding(X) * (self.d_model ** 0.5))
-    for layer in self.layers:
-      X = layer(X, valid_len)
+    past = cache[0]['key'].shape[1] if cache and cache[0] else 0
+    evicted = cache[0].get('evicted', 0) if cache else 0
+    # past the window the positions keep counting, without growing the shared table
+    X = self.pos_enc(self.embedding(X) * (self.d_model ** 0.5), evicted + past, shared=not evicted)
+    for i, layer in enumerate(self.layers):
+      X = layer(X, valid_len, cache[i] if cache is not None else None)
     Y = self.dense(X)
     
     return Y
 
 class Transformer(nn.Module):
   """The base class for the encoder-decoder architecture."""
-  def __init__(self, decoder, **kwargs):
+  def __init__(self, decoder, window=None, **kwargs):
     super(Transformer, self).__init__(**kwargs)
+    """
+    Inputs:
+      window: int, optional, number of past positions attended to in generation. Older keys/values
+        are evicted from the cache, so memory and time per token stay flat for long pieces.
+    """
     self.decoder = decoder
+    self.window = window
 
   def forward(self, tgt_array, tgt_valid_len):
     """Forward function"""
@@ -263,7 +334,53 @@ class Transformer(nn.Module):
     
     return loss, preds
         
-  def predict(self, tgt_array, tgt_valid_len):
+  def prime(self, tokens):
+    cache = self.decoder.init_cache()
+    logits = self.decoder(tokens, None, cache)[:, -1]
+    if self.window is not None:
+      cache = self.decoder.evict(cache, self.window)
+    return logits, cache
+
+  def step(self, tokens, cache, t):
+    # every token runs through the decoder layers exactly once
+    logits = self.decoder(tokens.unsqueeze(1), None, cache)[:, -1]
+    if self.window is not None:
+      cache = self.decoder.evict(cache, self.window)
+    return logits, cache
+
+  def extend(self, tokens, cache):
+    """Runs the tokens (N, k) of the next k positions in one pass, returns the logits (N, k, vocab_size) of each"""
+    if self.window is not None:
+      raise ValueError('verifying several positions in one pass needs the whole history, not a window')
+    return self.decoder(tokens, None, cache), cache
+
+  def rewind(self, cache, length):
+    """Drops the cached positions from `length` on"""
+    for layer_cache in cache:
+      layer_cache['key'] = layer_cache['key'][:, :length]
+      layer_cache['value'] = layer_cache['value'][:, :length]
+    return cache
+
+  def select_state(self, cache, index):
+    return [{**layer_cache, 'key': layer_cache['key'][index], 'value': layer_cache['value'][index]}
+            for layer_cache in cache]
+
+  def join_states(self, caches):
+    return [{**layers[0], 'key': torch.cat([layer_cache['key'] for layer_cache in layers]),
+             'value': torch.cat([layer_cache['value'] for layer_cache in layers])}
+            for layers in zip(*caches)]
+
+  def predict(self, tgt_array, tgt_valid_len, prefix_len=None, duration=None, use_cache=True):
+    """
+    tgt_array: tensor of size (N, T), prefixes right-padded to the longest one
+    prefix_len: tensor of size (N,), optional, prefix length of each row
+    duration: tensor of size (N,), optional, seconds of music of each row
+    use_cache: bool, with False every step reruns the decoder over the whole sequence
+    """
+    if use_cache:
+      return decode(self, tgt_array, tgt_valid_len, prefix_len, duration)
+
+    prefix_len = prefix_lengths(tgt_array, prefix_len)
     N, T = tgt_array.shape
 
     inputs = tgt_array[:, :1]
@@ -271,11 +388,8 @@ class Transformer(nn.Module):
 
     for t in range(torch.max(tgt_valid_len)-1):
       o = self.decoder(inputs, tgt_valid_len)
-      if t+1 < T:
-        output = tgt_array[:, t+1:t+2]
-      else:
-        output = o[:,-1:].argmax(dim=-1)
+      output = force_prefix(tgt_array, prefix_len, t+1, o[:,-1:].argmax(dim=-1))
       outputs.append(output)
       inputs = torch.cat(outputs, dim=1)
       
-    return inputs[:, 1:]
+    return limit_duration(inputs[:, 1:], prefix_len, duration)
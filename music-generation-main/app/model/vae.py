@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from model import device, pad_token
+from model import pad_token, latent_noise
+from model.decoding import decode
+from model.gru_step import fused_gru_step
 
 class VAEEncoder(nn.Module):
   def __init__(self, vocab_size, embedding_dim, hidden_size, num_layers, latent_dim):
@@ -87,21 +89,26 @@ class VAE(nn.Module):
     
     return elbo, preds
 
-  def predict(self, target, valid_len):
-    N, T = target.shape
-    h = target.new_zeros(self.num_layers, N, self.hidden_size).float()
-    z = torch.randn(N, self.latent_dim).to(device)
+  def prime(self, tokens, seeds=None):
+    N, _ = tokens.shape
+    h = tokens.new_zeros(self.num_layers, N, self.hidden_size).float()
+    z = latent_noise(N, self.latent_dim, seeds)
+    pred, h = self.decoder(z, tokens, h)
+    # generated tokens go through the precomputed embedding-to-gate table, the z part is computed once
+    latent = fused_gru_step(self, self.decoder.embedding, self.decoder.rnn).latent(z)
+    return pred[:, -1], (h, latent)
 
-    inputs = target[:, :1]
-    preds = []
+  def step(self, tokens, state, t):
+    h, latent = state
+    o, h = fused_gru_step(self, self.decoder.embedding, self.decoder.rnn)(tokens, h, latent)
+    return self.decoder.fc(o), (h, latent)
 
-    for t in range(torch.max(valid_len)-1):
-      pred, h = self.decoder(z, inputs, h)
-      if t+1 < T:
-        inputs = target[:, t+1:t+2]
-      else:
-        inputs = pred.argmax(dim=-1)
-      preds.append(inputs)
-      
-    preds = torch.cat(preds, dim=1)
-    return preds
+  def select_state(self, state, index):
+    h, latent = state
+    return h[:, index], latent[index]
+
+  def join_states(self, states):
+    return torch.cat([h for h, _ in states], dim=1), torch.cat([latent for _, latent in states])
+
+  def predict(self, target, valid_len, prefix_len=None, duration=None, seeds=None):
+    return decode(self, target, valid_len, prefix_len, duration, seeds)
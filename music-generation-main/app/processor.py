@@ -1,6 +1,7 @@
 import logging
 from uuid import uuid4
 
+import numpy as np
 import pretty_midi
 
 
@@ -151,6 +152,38 @@ def _event_seq2snote_seq(event_sequence):
     return snote_seq
 
 
+class EventDecoder:
+    """
+    Turns event ids into notes one event at a time, with the semantics of _event_seq2snote_seq and
+    _merge_note: the notes pushed out for a sequence are the ones decode_midi builds from it.
+    """
+
+    def __init__(self):
+        self.timeline = 0
+        # hundredths of a second, counted exactly
+        self.ticks = 0
+        self.velocity = 0
+        self._note_on = {}
+
+    def push(self, idx):
+        """Returns the note completed by event idx, None if it does not complete one"""
+        event = Event.from_int(idx)
+        if event.type == 'time_shift':
+            self.timeline += ((event.value+1) / 100)
+            self.ticks += event.value+1
+        elif event.type == 'velocity':
+            self.velocity = event.value * 4
+        elif event.type == 'note_on':
+            self._note_on[event.value] = SplitNote(event.type, self.timeline, event.value, self.velocity)
+        elif event.type == 'note_off':
+            on = self._note_on.get(event.value)
+            if on is None:
+                logging.warning('info removed pitch: {}'.format(event.value))
+            elif self.timeline - on.time != 0:
+                return pretty_midi.Note(on.velocity, event.value, on.time, self.timeline)
+        return None
+
+
 def _make_time_sift_events(prev_time, post_time):
     time_interval = int(round((post_time - prev_time) * 100))
     results = []
@@ -207,58 +240,276 @@ def _note_preprocess(susteins, notes):
     return note_stream
 
 
-def encode_midi(file_path):
-    events = []
-    notes = []
-    mid = pretty_midi.PrettyMIDI(midi_file=file_path)
-
-    for inst in mid.instruments:
-        inst_notes = inst.notes
-        # ctrl.number is the number of sustain control. If you want to know abour the number type of control,
-        # see https://www.midi.org/specifications-old/item/table-3-control-change-messages-data-bytes-2
-        ctrls = _control_preprocess([ctrl for ctrl in inst.control_changes if ctrl.number == 64])
-        notes += _note_preprocess(ctrls, inst_notes)
-
-    dnotes = _divide_note(notes)
+NOTE_DTYPE = np.dtype([('start', np.float64), ('end', np.float64), ('pitch', np.int64), ('velocity', np.int64)])
+
+
+def _note_array(notes):
+    """Structured array of pretty_midi notes, in their order"""
+    return np.array([(note.start, note.end, note.pitch, note.velocity) for note in notes], dtype=NOTE_DTYPE)
+
+
+def _sustain_windows(times, values):
+    """
+    (starts, ends) of the sustain windows of pedal control changes, as _control_preprocess finds them: a window
+    opens at the first control of a run of pedal downs and ends at the last control of the run of pedal ups
+    after it. Ups before the first down and a down run that is never released make no window.
+    """
+    if len(values) == 0:
+        return np.empty(0), np.empty(0)
+    down = values >= 64
+    runs = np.flatnonzero(np.r_[True, down[1:] != down[:-1]])
+    last = np.r_[runs[1:], len(down)] - 1
+    opened = np.flatnonzero(down[runs[:-1]])
+    return times[runs[opened]], times[last[opened + 1]]
+
+
+def _first_past(start, index, sustain_start, sustain_end):
+    """First note from index on that ends the scan of a sustain window, len(start) if none does"""
+    size = 64
+    while index < len(start):
+        chunk = start[index:index + size]
+        past = np.flatnonzero((chunk >= sustain_start) & (chunk > sustain_end))
+        if len(past):
+            return index + int(past[0])
+        index += size
+        size *= 2
+    return len(start)
+
+
+def _sustain_notes(notes, starts, ends):
+    """
+    _note_preprocess on a note array, with one sweep over the notes: each sustain window scans on from where
+    the previous one stopped. Keeps its quirks so that tokens do not change: a window that no note starts
+    after is not transposed and the next one scans the same notes again, and the notes after the last window
+    are dropped.
+    """
+    if len(starts) == 0:
+        return notes[np.argsort(notes['start'], kind='stable')]
+    start, pitch = notes['start'], notes['pitch']
+    end = notes['end'].copy()
+    streamed, managed = [], []
+    index = 0
+    for sustain_start, sustain_end in zip(starts.tolist(), ends.tolist()):
+        past = _first_past(start, index, sustain_start, sustain_end)
+        scanned = np.arange(index, past)
+        before = start[scanned] < sustain_start
+        streamed.append(scanned[before])
+        kept = scanned[~before]
+        managed.append(kept)
+        if past == len(start):
+            continue
+        index = past
+        # SustainDownManager.transposition_notes: a note lasts until the next one of its pitch in the window
+        # starts, the last one of a pitch at least until the pedal is released
+        order = kept[np.lexsort((np.arange(len(kept)), pitch[kept]))]
+        following = np.append(pitch[order][1:] == pitch[order][:-1], False)
+        end[order] = np.where(following, start[np.roll(order, -1)], np.maximum(sustain_end, end[order]))
+    kept = np.concatenate(streamed + managed)
+    kept = kept[np.argsort(start[kept], kind='stable')]
+    result = notes[kept]
+    result['end'] = end[kept]
+    return result
 
-    # print(dnotes)
-    dnotes.sort(key=lambda x: x.time)
-    # print('sorted:')
-    # print(dnotes)
-    cur_time = 0
-    cur_vel = 0
-    for snote in dnotes:
-        events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
-        events += _snote2events(snote=snote, prev_vel=cur_vel)
-        # events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
 
-        cur_time = snote.time
-        cur_vel = snote.velocity
+def _note_tokens(notes):
+    """Tokens of a note array, the events the loop of _encode_reference emits"""
+    notes = notes[np.argsort(notes['start'], kind='stable')]
+    count = len(notes)
+    times = np.empty(2 * count)
+    times[0::2], times[1::2] = notes['start'], notes['end']
+    pitch = np.repeat(notes['pitch'], 2)
+    velocity = np.repeat(notes['velocity'], 2)
+    is_on = np.tile([True, False], count)
+    order = np.argsort(times, kind='stable')
+    times, pitch, velocity, is_on = times[order], pitch[order], velocity[order], is_on[order]
+
+    # each gap is rounded on its own, as _make_time_sift_events does
+    intervals = np.rint((times - np.r_[0.0, times[:-1]]) * 100).astype(np.int64)
+    full, rest = np.divmod(intervals, RANGE_TIME_SHIFT)
+    # _snote2events compares velocity // 4 with the raw velocity of the previous split note, None after a note_off
+    previous_on = np.r_[True, is_on[:-1]]
+    previous_velocity = np.r_[0, velocity[:-1]]
+    with_velocity = is_on & ~(previous_on & (previous_velocity == velocity // 4))
+
+    sizes = full + (rest > 0) + with_velocity + 1
+    offsets = np.cumsum(sizes) - sizes
+    tokens = np.empty(int(sizes.sum()), dtype=np.int64)
+    repeats = np.arange(int(full.sum())) - np.repeat(np.cumsum(full) - full, full)
+    tokens[np.repeat(offsets, full) + repeats] = START_IDX['time_shift'] + RANGE_TIME_SHIFT - 1
+    tokens[(offsets + full)[rest > 0]] = START_IDX['time_shift'] + rest[rest > 0] - 1
+    tokens[(offsets + full + (rest > 0))[with_velocity]] = START_IDX['velocity'] + velocity[with_velocity] // 4
+    tokens[offsets + sizes - 1] = np.where(is_on, START_IDX['note_on'] + pitch, START_IDX['note_off'] + pitch)
+    return tokens.tolist()
 
-    return [e.to_int() for e in events]
 
+def encode_midi(file_path):
+    return encode_pretty_midi(pretty_midi.PrettyMIDI(midi_file=file_path))
 
-def decode_midi(idx_array, file_path=None):
-    from app.util import BASE_DIR
-    logging.warning(f"decode_midi")
-    logging.warning(f"idx_array: {idx_array}")
-    event_sequence = [Event.from_int(idx) for idx in idx_array]
-    logging.warning(f"event_sequence: {event_sequence}")
-    snote_seq = _event_seq2snote_seq(event_sequence)
-    note_seq = _merge_note(snote_seq)
-    note_seq.sort(key=lambda x:x.start)
 
+def encode_pretty_midi(mid):
+    """Tokens of a loaded PrettyMIDI, see encode_midi"""
+    notes = []
+    for inst in mid.instruments:
+        # ctrl.number is the number of sustain control. If you want to know abour the number type of control,
+        # see https://www.midi.org/specifications-old/item/table-3-control-change-messages-data-bytes-2
+        ctrls = [ctrl for ctrl in inst.control_changes if ctrl.number == 64]
+        starts, ends = _sustain_windows(np.array([ctrl.time for ctrl in ctrls]), np.array([ctrl.value for ctrl in ctrls]))
+        notes.append(_sustain_notes(_note_array(inst.notes), starts, ends))
+    return _note_tokens(np.concatenate(notes) if notes else np.empty(0, dtype=NOTE_DTYPE))
+
+
+def note_arrays(idx_array):
+    """
+    (velocity, pitch, start, end) arrays of the notes an event sequence decodes to, in the order of
+    _merge_note(_event_seq2snote_seq(...)) sorted by start, with array ops instead of one object per event.
+    """
+    idx = np.asarray(idx_array, dtype=np.int64).reshape(-1)
+    positions = np.arange(len(idx))
+    is_on = (idx >= 0) & (idx < START_IDX['note_off'])
+    is_off = (idx >= START_IDX['note_off']) & (idx < START_IDX['time_shift'])
+    is_shift = (idx >= START_IDX['time_shift']) & (idx < START_IDX['velocity'])
+    is_velocity = ~(is_on | is_off | is_shift)
+
+    # cumsum adds in sequence order, so the times are the ones of the float timeline of _event_seq2snote_seq
+    timeline = np.cumsum(np.where(is_shift, (idx - START_IDX['time_shift'] + 1) / 100, 0.0))
+    # velocity of the last velocity event before each event
+    last_velocity = np.maximum.accumulate(np.where(is_velocity, positions, -1))
+    velocity = np.where(last_velocity >= 0, (idx[last_velocity] - START_IDX['velocity']) * 4, 0)
+
+    # note events grouped by pitch, in sequence order within a group: each note_off is paired with the last
+    # note_on of its group before it
+    keyed = np.flatnonzero(is_on | is_off)
+    pitch = np.where(is_on, idx, idx - START_IDX['note_off'])[keyed]
+    order = np.lexsort((keyed, pitch))
+    keyed, pitch = keyed[order], pitch[order]
+    group = np.cumsum(np.r_[False, pitch[1:] != pitch[:-1]])
+    stride = len(idx) + 1
+    last_on = np.maximum.accumulate(group * stride + np.where(is_on[keyed], keyed + 1, 0)) - group * stride - 1
+
+    off = is_off[keyed]
+    offs, ons, pitch = keyed[off], last_on[off], pitch[off]
+    # back to the order the note_offs come in
+    order = np.argsort(offs, kind='stable')
+    offs, ons, pitch = offs[order], ons[order], pitch[order]
+    if (ons < 0).any():
+        logging.warning('info removed pitches: {}'.format(pitch[ons < 0].tolist()))
+    offs, ons, pitch = offs[ons >= 0], ons[ons >= 0], pitch[ons >= 0]
+
+    start, end = timeline[ons], timeline[offs]
+    kept = end - start != 0
+    velocity, pitch, start, end = velocity[ons][kept], pitch[kept], start[kept], end[kept]
+    order = np.argsort(start, kind='stable')
+    return velocity[order], pitch[order], start[order], end[order]
+
+
+def _pretty_notes(velocity, pitch, start, end):
+    return [pretty_midi.Note(*note) for note in zip(velocity.tolist(), pitch.tolist(), start.tolist(), end.tolist())]
+
+
+def _decode_notes(idx_array):
+    return _pretty_notes(*note_arrays(idx_array))
+
+
+PROGRAM = 1
+TRACK_NAME = "Developed By Madiyar Toktarbekov"
+
+
+def notes_midi(notes):
+    """PrettyMIDI of the (velocity, pitch, start, end) arrays of note_arrays, the one decode_midi builds"""
     mid = pretty_midi.PrettyMIDI()
     # if want to change instument, see https://www.midi.org/specifications/item/gm-level-1-sound-set
-    instument = pretty_midi.Instrument(1, False, "Developed By Madiyar Toktarbekov")
-    instument.notes = note_seq
+    instument = pretty_midi.Instrument(PROGRAM, False, TRACK_NAME)
+    instument.notes = _pretty_notes(*notes)
 
     mid.instruments.append(instument)
+    return mid
+
+
+def decode_midi(idx_array, file_path=None):
+    mid = notes_midi(note_arrays(idx_array))
     if file_path is not None:
         mid.write(file_path)
     return mid
 
 
+# PrettyMIDI defaults, the timing decode_midi files are written with
+MIDI_RESOLUTION = 220
+MIDI_TEMPO = 120
+
+
+def _variable_int(value):
+    """MIDI variable-length quantity"""
+    result = [value & 0x7F]
+    value >>= 7
+    while value:
+        result.append(value & 0x7F | 0x80)
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def _meta_event(kind, data):
+    """Meta event at delta time 0"""
+    return b'\x00\xff' + bytes([kind]) + _variable_int(len(data)) + data
+
+
+def _chunk(kind, data):
+    return kind + len(data).to_bytes(4, 'big') + data
+
+
+# set_tempo and 4/4 time_signature, then end_of_track one tick later, as PrettyMIDI.write() orders them
+_TIMING_TRACK = _chunk(b'MTrk', _meta_event(0x51, (60_000_000 // MIDI_TEMPO).to_bytes(3, 'big'))
+                       + _meta_event(0x58, bytes([4, 2, 24, 8])) + b'\x01\xff\x2f\x00')
+_HEADER = _chunk(b'MThd', (1).to_bytes(2, 'big') + (2).to_bytes(2, 'big') + MIDI_RESOLUTION.to_bytes(2, 'big'))
+# track name and program change on channel 0
+_TRACK_START = _meta_event(0x03, TRACK_NAME.encode('latin1')) + bytes([0x00, 0xC0, PROGRAM])
+
+
+def midi_file_bytes(velocity, pitch, start, end):
+    """
+    Standard MIDI File of the notes (arrays, as returned by note_arrays) in one instrument track, the bytes
+    decode_midi() writes through pretty_midi and mido without building a message object per event.
+    """
+    tick_scale = 60.0 / (MIDI_TEMPO * MIDI_RESOLUTION)
+    count = len(pitch)
+    ticks = np.rint(np.concatenate([start, end]) / tick_scale).astype(np.int64)
+    notes = np.concatenate([pitch, pitch]).astype(np.int64)
+    velocities = np.concatenate([velocity, np.zeros(count, dtype=np.int64)]).astype(np.int64)
+    # by tick, then pitch, then velocity, so a note_off sorts before a note_on of its pitch and tick
+    order = np.lexsort((velocities, notes, ticks))
+    ticks, notes, velocities = ticks[order], notes[order], velocities[order]
+    deltas = np.diff(ticks, prepend=0)
+
+    # every event but the first one is written with running status: delta, pitch, velocity
+    widths = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    sizes = widths + 2
+    sizes[:1] += 1
+    offsets = np.cumsum(sizes) - sizes
+    events = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    for i in range(4):
+        written = widths > i
+        shift = 7 * (widths[written] - 1 - i)
+        more = np.where(i < widths[written] - 1, 0x80, 0)
+        events[offsets[written] + i] = (deltas[written] >> shift) & 0x7F | more
+    data = offsets + widths
+    if len(events):
+        events[data[0]] = 0x90
+        data[0] += 1
+    events[data] = notes
+    events[data + 1] = velocities
+
+    end_of_track = _variable_int(1) + b'\xff\x2f\x00'
+    track = bytearray(len(_TRACK_START) + len(events) + len(end_of_track))
+    track[:len(_TRACK_START)] = _TRACK_START
+    track[len(_TRACK_START):len(_TRACK_START) + len(events)] = events.tobytes()
+    track[len(_TRACK_START) + len(events):] = end_of_track
+    return _HEADER + _TIMING_TRACK + _chunk(b'MTrk', bytes(track))
+
+
+def decode_midi_bytes(idx_array):
+    """The bytes of the MIDI file decode_midi(idx_array) writes"""
+    return midi_file_bytes(*note_arrays(idx_array))
+
+
 if __name__ == '__main__':
     encoded = encode_midi('bin/ADIG04.mid')
     logging.warning(encoded)
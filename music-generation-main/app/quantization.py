@@ -0,0 +1,111 @@
+"""
+Dynamic int8 quantization of the models for CPU serving.
+
+nn.GRU and nn.Linear weights are quantized ahead of time, activations at run time. The CNN
+convolutions are not supported by dynamic quantization, so the CNN decoding steps are first
+linearized (see WaveNet.linearize) and those linear layers are quantized.
+The quantized state dicts can be cached next to the checkpoints as <name>.int8.pt.
+
+Usage:
+  python quantization.py                # quantizes every model, saves the artifacts and checks them
+  python quantization.py rnn --no-save
+"""
+import os
+import logging
+import argparse
+import torch
+import torch.nn as nn
+from model import device
+
+AGREEMENT_PREFIXES = 8
+AGREEMENT_PREFIX_LEN = 16
+AGREEMENT_LENGTH = 128
+
+
+def quantize_model(name, model):
+    if name == "cnn":
+        model.cnn.linearize()
+    quantized = torch.quantization.quantize_dynamic(model, {nn.GRU, nn.Linear}, dtype=torch.qint8)
+    quantized.eval()
+    return quantized
+
+
+def artifact_path(prefix):
+    return f'{prefix}.int8.pt'
+
+
+def _load_artifact(path):
+    # packed int8 weights are script objects, which torch >= 2.6 refuses to unpickle by default
+    try:
+        return torch.load(path, map_location=device, weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only argument
+        return torch.load(path, map_location=device)
+
+
+def load_quantized(name, loader, prefix, save=False):
+    """
+    Quantized version of the model built by `loader`, restored from its cached artifact when there
+    is one. The artifact is loaded into a quantized skeleton, loader(pretrained=False), so the float
+    weights are not read. With `save`, a missing artifact is written.
+    """
+    path = artifact_path(prefix)
+    if os.path.exists(path):
+        model = quantize_model(name, loader(pretrained=False))
+        model.load_state_dict(_load_artifact(path))
+        logging.warning(f'{path} loaded')
+        return model
+    model = quantize_model(name, loader())
+    if save:
+        torch.save(model.state_dict(), path)
+        logging.warning(f'{path} saved')
+    return model
+
+
+def agreement_prefixes(vocab_size, n=AGREEMENT_PREFIXES, length=AGREEMENT_PREFIX_LEN, seed=0):
+    """Fixed set of prefixes the float and quantized models are compared on"""
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randint(3, vocab_size, (n, length), generator=generator)
+
+
+def token_agreement(float_model, quantized_model, prefixes, length=AGREEMENT_LENGTH, seed=0):
+    """
+    Share of generated tokens (past the prefix) on which the quantized model agrees with the
+    float model. The random latent of VAE/GAN is drawn from the same seed for both.
+    """
+    prefixes = prefixes.to(device)
+    valid_len = torch.full((prefixes.shape[0],), length).to(device)
+    preds = []
+    for model in [float_model, quantized_model]:
+        with torch.no_grad(), torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            preds.append(model.predict(prefixes, valid_len))
+    generated = slice(prefixes.shape[1] - 1, None)
+    return (preds[0][:, generated] == preds[1][:, generated]).float().mean().item()
+
+
+def main():
+    from util import MODEL_LOADERS, DEFAULT_HPARAMS, checkpoint_prefix
+
+    parser = argparse.ArgumentParser(description="Build int8 quantized models and check them against the float ones")
+    parser.add_argument('models', nargs='*', help=f'models to quantize, all of {list(MODEL_LOADERS)} by default')
+    parser.add_argument('--no-save', action='store_true', help='only check the agreement')
+    parser.add_argument('--length', type=int, default=AGREEMENT_LENGTH)
+    args = parser.parse_args()
+    unknown = set(args.models) - set(MODEL_LOADERS)
+    if unknown:
+        parser.error(f'unknown models: {sorted(unknown)}')
+
+    for name in args.models or MODEL_LOADERS:
+        float_model = MODEL_LOADERS[name]()
+        # quantize_dynamic works on a copy, the float model stays usable for the comparison
+        quantized = quantize_model(name, float_model)
+        if not args.no_save:
+            torch.save(quantized.state_dict(), artifact_path(checkpoint_prefix(name)))
+        prefixes = agreement_prefixes(DEFAULT_HPARAMS[name]["vocab_size"])
+        agreement = token_agreement(float_model, quantized, prefixes, args.length)
+        print(f'{name}: token agreement {agreement:.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import os
+import logging
+from collections import OrderedDict
+from util import BASE_DIR
+
+RESULT_CACHE_MEMORY = int(os.environ.get("RESULT_CACHE_MEMORY", 32 * 2**20))
+RESULT_CACHE_DISK = int(os.environ.get("RESULT_CACHE_DISK", 512 * 2**20))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", f"{BASE_DIR}/cache/results")
+
+
+class ResultCache:
+    """
+    MIDI bytes of generated pieces by request key (see util.result_key), in two LRU tiers:
+    memory up to `memory_budget` bytes, and files in `directory` up to `disk_budget` bytes.
+    A disk hit is promoted to memory. A budget of 0 turns its tier off.
+    """
+
+    def __init__(self, memory_budget=RESULT_CACHE_MEMORY, disk_budget=RESULT_CACHE_DISK, directory=RESULT_CACHE_DIR):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.directory = directory
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        if self.disk_budget > 0:
+            self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.mid")
+
+    def _scan(self):
+        """Indexes the files left by previous runs, least recently used first"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".mid")]
+        except OSError as e:
+            logging.warning(f"result cache disabled on disk: {e}")
+            self.disk_budget = 0
+            return
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            size = entry.stat().st_size
+            self._disk[entry.name[:-len(".mid")]] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def get(self, key):
+        """MIDI bytes cached for key, None on a miss"""
+        midi = self._memory.get(key)
+        if midi is not None:
+            self._memory.move_to_end(key)
+            self.hits["memory"] += 1
+            return midi
+        if key in self._disk:
+            try:
+                with open(self._path(key), "rb") as f:
+                    midi = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                self._disk_size -= self._disk.pop(key)
+            else:
+                self._disk.move_to_end(key)
+                self.hits["disk"] += 1
+                self._put_memory(key, midi)
+                return midi
+        self.misses += 1
+        return None
+
+    def put(self, key, midi):
+        self._put_memory(key, midi)
+        if self.disk_budget > 0 and key not in self._disk and len(midi) <= self.disk_budget:
+            path = self._path(key)
+            try:
+                with open(f"{path}.tmp", "wb") as f:
+                    f.write(midi)
+                os.replace(f"{path}.tmp", path)
+            except OSError as e:
+                logging.warning(f"{path} could not be cached: {e}")
+                return
+            self._disk[key] = len(midi)
+            self._disk_size += len(midi)
+            self._evict_disk()
+
+    def _put_memory(self, key, midi):
+        if len(midi) > self.memory_budget:
+            return
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        self._memory[key] = midi
+        self._memory_size += len(midi)
+        while self._memory_size > self.memory_budget:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_budget:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        lookups = self.hits["memory"] + self.hits["disk"] + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "memory": {"entries": len(self._memory), "bytes": self._memory_size, "budget": self.memory_budget},
+            "disk": {"entries": len(self._disk), "bytes": self._disk_size, "budget": self.disk_budget},
+        }
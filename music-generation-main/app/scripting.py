@@ -0,0 +1,111 @@
+"""
+TorchScript-compiled inference.
+
+The decode loop of every model (see model/scripted.py) is scripted once and saved next to its
+checkpoint as <name>.ts (<name>.int8.ts for quantized models). The artifact records the torch
+version and the size/mtime of the weight files it was built from; when they no longer match, it is
+compiled again. Models that fail to compile are served in eager mode.
+
+A compiled decoder runs the whole generation in one call and has no prime()/step(), so with
+TORCHSCRIPT=1 the step-by-step endpoints, /segments and /generate/stream, answer 501 and the
+prefix cache is off.
+"""
+import os
+import json
+import logging
+import torch
+from model import device, prefix_lengths, latent_noise
+from model.decoding import limit_duration
+from model.scripted import script_decoder
+
+# part of the artifact key, bumped when the signature of the compiled decoders changes
+ARTIFACT_FORMAT = 2
+
+
+class ScriptedModel:
+    """Compiled decoder with the predict() interface of the eager models"""
+
+    def __init__(self, module):
+        self.module = module
+
+    @property
+    def latent_dim(self):
+        return getattr(self.module, 'latent_dim', 0)
+
+    def predict(self, target, valid_len, prefix_len=None, duration=None, seeds=None):
+        prefix_len = prefix_lengths(target, prefix_len)
+        if seeds is None:
+            outputs = self.module(target, valid_len, prefix_len)
+        else:
+            z = latent_noise(target.shape[0], self.latent_dim, seeds)
+            outputs = self.module(target, valid_len, prefix_len, z)
+        return limit_duration(outputs, prefix_len, duration)
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+
+def artifact_path(prefix, quantized=False):
+    return f'{prefix}.int8.ts' if quantized else f'{prefix}.ts'
+
+
+def artifact_key(prefix, quantized=False, window=None):
+    """
+    Identifies the torch version, the weight files and the attention window (compiled into the transformer
+    decoder) a compiled artifact was built from, None without weights
+    """
+    sources = [f'{prefix}.pt', f'{prefix}.bin', f'{prefix}.json']
+    if quantized:
+        sources.append(f'{prefix}.int8.pt')
+    files = {os.path.basename(path): [os.path.getsize(path), os.path.getmtime(path)]
+             for path in sources if os.path.exists(path)}
+    if not files:
+        return None
+    return json.dumps({'torch': torch.__version__, 'files': files, 'format': ARTIFACT_FORMAT, 'window': window or 0},
+                      sort_keys=True)
+
+
+def _load_artifact(path, key):
+    if key is None or not os.path.exists(path):
+        return None
+    extra_files = {'key': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    stored = extra_files['key']
+    if isinstance(stored, bytes):
+        stored = stored.decode()
+    if stored != key:
+        logging.warning(f'{path} is out of date')
+        return None
+    logging.warning(f'{path} loaded')
+    return module
+
+
+def load_scripted(name, loader, prefix, quantized=False, window=None):
+    """
+    Compiled version of the model built by `loader`, from the cached artifact when it is up to date.
+    `window` is the attention window the loader builds the transformer with. Falls back to the eager
+    model when compilation fails.
+    """
+    path = artifact_path(prefix, quantized)
+    key = artifact_key(prefix, quantized, window)
+    try:
+        module = _load_artifact(path, key)
+        if module is not None:
+            return ScriptedModel(module).eval()
+    except Exception as e:
+        logging.warning(f'{path} could not be loaded: {e}')
+
+    model = loader()
+    try:
+        module = torch.jit.script(script_decoder(name, model).eval())
+    except Exception as e:
+        logging.warning(f'{name}: TorchScript compilation failed, serving the eager model: {e}')
+        return model
+    if key is not None:
+        try:
+            torch.jit.save(module, path, _extra_files={'key': key})
+            logging.warning(f'{path} saved')
+        except Exception as e:
+            logging.warning(f'{path} could not be saved: {e}')
+    return ScriptedModel(module).eval()
@@ -0,0 +1,67 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 1000))
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 3600))
+
+
+class Session:
+    """A piece generated segment by segment, with the model state carried over to the next segment"""
+
+    def __init__(self, model, prefix, seed=None):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.prefix = list(prefix)
+        self.seed = seed
+        self.tokens = []
+        # (logits, state, position) of the model after the last segment
+        self.carry = None
+        self.finished = False
+        self.lock = asyncio.Lock()
+        self.touched = time.monotonic()
+
+
+class SessionStore:
+    """
+    Sessions of the segmented generation, in LRU order.
+    A session expires `ttl` seconds after its last segment; once more than `max_sessions` are
+    kept the least recently used one is dropped.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.max_sessions = max(1, max_sessions)
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def create(self, model, prefix, seed=None):
+        self._expire()
+        session = Session(model, prefix, seed)
+        self._sessions[session.id] = session
+        while len(self._sessions) > self.max_sessions:
+            evicted, _ = self._sessions.popitem(last=False)
+            logging.warning(f"session {evicted} evicted")
+        return session
+
+    def get(self, session_id):
+        """The session, None if it is unknown or expired"""
+        self._expire()
+        session = self._sessions.get(session_id)
+        if session is not None:
+            session.touched = time.monotonic()
+            self._sessions.move_to_end(session_id)
+        return session
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.touched > deadline:
+                break
+            self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
@@ -27,6 +27,9 @@ bot = Bot(token=config)
 # available_model_names = ["rnn", "gan", "vae", "cnn"]
 available_model_names = ["rnn", "vae", "cnn"]
 
+# generation stops at the requested duration, the length only caps the tokens
+MAX_TOKENS_PER_SECOND = 100
+
 estimations = [str(i) for i in range(10, 0, -1)]
 
 
@@ -35,12 +38,13 @@ class MusicGeneration(StatesGroup):
     waiting_for_model_user_estimation = State()
 
 
-async def generate_music_by_input(random_sample, model, length):
+async def generate_music_by_input(random_sample, model, duration):
     generate_request = GenerateRequest(
         model=model,
-        length=length,
+        length=duration * MAX_TOKENS_PER_SECOND,
         prefix=random_sample,
         is_mid=True,
+        duration=duration,
     )
 
     logging.info(f"generate_request {generate_request}")
@@ -72,7 +76,7 @@ async def model_start(message: types.Message, state: FSMContext):
 
 
 async def model_length(message: types.Message, state: FSMContext):
-    incorrect_format_message = "Пожалуйста, введите длину песни в секундах (до 40). Длина мелодии будет примерно (+-5) секунд 😁"
+    incorrect_format_message = "Пожалуйста, введите длину песни в секундах (до 40) 😁"
 
     if not message.text.isnumeric():
         await message.answer(incorrect_format_message)
@@ -84,14 +88,14 @@ async def model_length(message: types.Message, state: FSMContext):
 
     length = int(message.text)
 
-    await state.update_data(length=int(length) * 50)
+    await state.update_data(length=length)
     await message.answer(f"Вы выбрали длину {length}", reply_markup=types.ReplyKeyboardRemove())
 
     logging.info(f"length - {length}")
 
     user_data = await state.get_data()
 
-    await message.answer(f"Вы выбрали длину {user_data['length'] / 50}. Вам будут предложены 3 мелодии разных моделей, оцените их, пожалуйста. "
+    await message.answer(f"Вы выбрали длину {user_data['length']}. Вам будут предложены 3 мелодии разных моделей, оцените их, пожалуйста. "
                          f"Ожидайте сгенерированную музыку... 🎵🎵🎵")
 
     random_sample = random.sample(range(1, 255), 50)
@@ -1,52 +1,225 @@
 import os
+import json
 import torch
+import hashlib
 import logging
 import itertools
+import functools
+import threading
+from collections import OrderedDict
 from io import BytesIO
 from pathlib import Path
-from typing import List, Literal
-from pydantic import BaseModel
-from processor import decode_midi
-from model import device
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field, conint
+from processor import note_arrays, midi_file_bytes
+from checkpoint import read_manifest, load_weights, weights_path
+from quantization import load_quantized
+from scripting import load_scripted
+from model.speculative import SpeculativeModel
+from model import device, bos_token, eos_token, pad_token
+from model.decoding import decode_segment
+from model.prefix_cache import PrefixCache, prime
 from model.rnn import RNN
 from model.cnn import WaveNet, CNN
-from model.transformer import TransformerDecoder, Transformer
+from model.transformer import TransformerDecoder, Transformer, MAX_POSITIONS
 from model.vae import VAE
 from model.gan import Generator
 
 BASE_DIR = Path(__file__).resolve(strict=True).parent.parent
 
+# 388 events and the pad/bos/eos tokens
+VOCAB_SIZE = 388 + 3
+Token = conint(ge=0, lt=VOCAB_SIZE)
+# tokens of a piece, prefix included: the token buffer of a batch is allocated for its longest piece
+MAX_LENGTH = int(os.environ.get("MAX_LENGTH", 10000))
+
 
 class GenerateRequest(BaseModel):
     model: Literal['rnn', 'cnn', 'transformer', 'vae', 'gan']
-    length: int
-    prefix: List[int]
+    # tokens of the piece, prefix included, see check_generation
+    length: int = Field(gt=0)
+    prefix: List[Token]
     is_mid: bool = False
+    # seconds of music, generation stops once reached, length still caps the tokens
+    duration: Optional[float] = Field(None, gt=0)
+    # seed of the latent noise of vae/gan, the same request then gives the same piece
+    seed: Optional[int] = None
+
+
+class SegmentRequest(BaseModel):
+    # models with a fixed-size state, see sessions.py
+    model: Literal['rnn', 'vae', 'gan']
+    length: int = Field(gt=0)
+    prefix: List[Token]
+    seed: Optional[int] = None
+
+
+class ContinueRequest(BaseModel):
+    length: int = Field(gt=0)
+
+
+def max_length(name):
+    """Longest piece model `name` generates, the transformer attending over the whole piece is bound by its encoding"""
+    if name == "transformer" and not TRANSFORMER_WINDOW:
+        return min(MAX_LENGTH, MAX_POSITIONS)
+    return MAX_LENGTH
+
 
+def check_generation(length, prefix, name):
+    """
+    Raises ValueError for a piece that cannot be generated, so that a request is refused on its own
+    before it joins a batch
+    """
+    if not prefix:
+        raise ValueError("prefix must hold at least one token")
+    if length <= len(prefix):
+        raise ValueError(f"length {length} leaves nothing to generate after a prefix of {len(prefix)} tokens")
+    if length > max_length(name):
+        raise ValueError(f"length {length} is over the {max_length(name)} tokens {name} generates")
 
-def generate_buffer(model, length, prefix):
-    logging.warning(f"generate_buffer")
-    buffer = BytesIO()
-    decided = ""
-    primer = torch.tensor([prefix]).to(device)
-    valid_len = torch.full((1,), length).to(device)
-    preds = model.predict(primer, valid_len)
+
+def check_segment(prefix):
+    """Raises ValueError for a segmented piece that cannot be started, see check_generation"""
+    if not prefix:
+        raise ValueError("prefix must hold at least one token")
+
+
+def generate_buffer(model, length, prefix, duration=None, seed=None):
+    return generate_buffers(model, [length], [prefix], [duration], [seed])[0]
+
+
+def generate_buffers(model, lengths, prefixes, durations=None, seeds=None):
+    """
+    Generates a batch of pieces in one predict call.
+    Prefixes are right-padded to the longest one. Every row is cut to its own length, or to its duration
+    in seconds when it has one: the decoding engine stops a row there, decoders that run the whole batch
+    to the longest length are cut here. Models with a latent draw the noise of rows with a seed from their
+    own generator, so those rows are the pieces a solo request gives; rows without a seed draw from the
+    global generator and depend on the rest of the batch.
+    Returns a list of (decided, buffer) per row.
+    """
+    logging.warning(f"generate_buffers: {len(prefixes)}")
+    T = max(len(prefix) for prefix in prefixes)
+    primer = torch.full((len(prefixes), T), pad_token)
+    for i, prefix in enumerate(prefixes):
+        primer[i, :len(prefix)] = torch.tensor(prefix)
+    primer = primer.to(device)
+    prefix_len = torch.tensor([len(prefix) for prefix in prefixes]).to(device)
+    valid_len = torch.tensor(lengths).to(device)
+    duration = None
+    if durations is not None and any(d is not None for d in durations):
+        duration = torch.tensor([float('inf') if d is None else d for d in durations]).to(device)
+    with torch.no_grad():
+        if getattr(model, "latent_dim", 0) and seeds is not None and any(s is not None for s in seeds):
+            preds = model.predict(primer, valid_len, prefix_len, duration, seeds)
+        else:
+            preds = model.predict(primer, valid_len, prefix_len, duration)
     logging.warning(f"preds: {preds}")
+    results = []
     for i, pred in enumerate(preds):
-        raw = (pred - 3).tolist()[:valid_len[i]]
+        raw = pred[:valid_len[i] - 1].tolist()
         logging.warning(f"raw: {raw}")
-        # enc = list(itertools.takewhile(lambda x: x >= 0, raw))
-        enc = raw
-        logging.warning(f"enc: {enc}, buffer: {buffer}")
-        decided = decode_midi(enc, buffer)
-        buffer.seek(0)
-    return decided, buffer
+        # positions 1..prefix_len-1 are the prefix
+        results.append(midi_buffer(raw[:prefix_len[i] - 1], raw[prefix_len[i] - 1:]))
+    return results
+
+
+def midi_buffer(prefix, generated):
+    """
+    (decided, buffer) of the prefix tokens followed by the generated ones up to eos. The file is written
+    without building a PrettyMIDI, decided is the (velocity, pitch, start, end) arrays of its notes:
+    processor.notes_midi builds the PrettyMIDI decode_midi would from them.
+    """
+    generated = itertools.takewhile(lambda x: x not in (eos_token, pad_token), generated)
+    # pad/bos/eos are not events
+    enc = [token - 3 for token in itertools.chain(prefix, generated) if token >= 3]
+    notes = note_arrays(enc)
+    return notes, BytesIO(midi_file_bytes(*notes))
+
+
+class SteppingUnavailable(Exception):
+    """The served model has no prime()/step(), e.g. a TorchScript-compiled decoder"""
+
+
+def check_stepping():
+    """Raises SteppingUnavailable when the served models do not decode step by step"""
+    if TORCHSCRIPT:
+        raise SteppingUnavailable("segments and streaming are not available with TorchScript decoders (TORCHSCRIPT=1)")
+
+
+def generate_segment(model, length, prefix=None, carry=None, seed=None):
+    """
+    Generates the next `length` tokens of a single piece, from its prefix or from the carry of the
+    previous segment, so that nothing is recomputed.
+    Returns the tokens, the carry for the next segment and whether the piece reached eos.
+    """
+    if not hasattr(model, "step"):
+        raise SteppingUnavailable(f"{type(model).__name__} does not decode step by step")
+    if length <= 0:
+        raise ValueError(f"segment length must be positive, got {length}")
+    with torch.no_grad():
+        if carry is None:
+            check_segment(prefix)
+            seeds = [seed] if getattr(model, "latent_dim", 0) and seed is not None else None
+            logits, state = prime(model, torch.tensor([prefix]).to(device), seeds)
+            position = len(prefix) - 1
+        else:
+            logits, state, position = carry
+        tokens, logits, state, finished = decode_segment(model, logits, state, position, length)
+    return tokens[0].tolist(), (logits, state, position + tokens.shape[1]), bool(finished[0])
+
+
+CHECKPOINT_NAMES = {
+    "rnn": "rnn",
+    "cnn": "cnn",
+    "transformer": "transformer",
+    "vae": "vae",
+    "gan": "generator",
+}
+
+# used when a model has no inference checkpoint manifest, see checkpoint.py
+DEFAULT_HPARAMS = {
+    "rnn": {"vocab_size": VOCAB_SIZE, "embedding_dim": 256, "hidden_size": 512, "num_layers": 3},
+    "cnn": {"vocab_size": VOCAB_SIZE, "embedding_dim": 256, "res_channels": 512, "dilation_depth": 10,
+            "num_repeat": 1, "kernel_size": 2},
+    "transformer": {"vocab_size": VOCAB_SIZE, "d_model": 256, "ffn_l1_size": 512, "ffn_l2_size": 256,
+                    "num_heads": 8, "num_layers": 8, "dropout": 0.1},
+    "vae": {"vocab_size": VOCAB_SIZE, "embedding_dim": 256, "hidden_size": 512, "num_layers": 3, "latent_dim": 64},
+    "gan": {"vocab_size": VOCAB_SIZE, "embedding_dim": 256, "hidden_size": 512, "num_layers": 3, "latent_dim": 64},
+}
+
+
+def checkpoint_prefix(name):
+    return f'{BASE_DIR}/checkpoint/{CHECKPOINT_NAMES[name]}'
+
+
+def model_hparams(name):
+    manifest = read_manifest(checkpoint_prefix(name))
+    return {**DEFAULT_HPARAMS[name], **(manifest or {}).get('hparams', {})}
+
+
+def build_model(name, hparams):
+    """Model `name` with random weights"""
+    if name == "cnn":
+        return CNN(WaveNet(**hparams))
+    if name == "transformer":
+        return Transformer(TransformerDecoder(**hparams, device=device))
+    return {"rnn": RNN, "vae": VAE, "gan": Generator}[name](**hparams)
 
 
 def load_model(model, file_dir):
+    """Loads the inference weights file next to `file_dir` if there is one, the training checkpoint otherwise"""
     logging.warning(f"load_model")
+    prefix = os.path.splitext(file_dir)[0]
+    manifest = read_manifest(prefix)
+    if manifest is not None:
+        model.load_state_dict(load_weights(prefix, manifest))
+        logging.warning(f'{weights_path(prefix)} loaded')
+        model.eval()
+        return
     if not os.path.exists(file_dir):
         logging.warning(f"load_model not os.path.exists(file_dir)")
+        model.eval()
         return
     checkpoint = torch.load(file_dir, map_location=device)
     model.load_state_dict(checkpoint['model_state_dict'])
@@ -54,66 +227,255 @@ def load_model(model, file_dir):
     model.eval()
 
 
-def load_rnn():
+def load_rnn(pretrained=True):
     logging.warning(f"load_rnn")
-    vocab_size = 388+3
-    embedding_dim = 256
-    hidden_size = 512
-    num_layers = 3
-    rnn_net = RNN(vocab_size, embedding_dim, hidden_size, num_layers).to(device)
+    hparams = model_hparams("rnn")
+    rnn_net = RNN(**hparams).to(device)
     logging.warning(BASE_DIR)
-    load_model(rnn_net, f'{BASE_DIR}/checkpoint/rnn.pt')
+    if pretrained:
+        load_model(rnn_net, f'{checkpoint_prefix("rnn")}.pt')
+    rnn_net.eval()
     return rnn_net
 
 
-def load_cnn():
+def load_cnn(pretrained=True):
     logging.warning(f"load_cnn")
-    vocab_size = 388+3
-    embedding_dim = 256
-    res_channels = 512
-    dilation_depth = 10
-    num_repeat = 1
-    kernel_size = 2
-    wave_net = WaveNet(vocab_size, embedding_dim, res_channels, dilation_depth, num_repeat, kernel_size)
+    hparams = model_hparams("cnn")
+    wave_net = WaveNet(**hparams)
     cnn_net = CNN(wave_net).to(device)
-    load_model(cnn_net, f'{BASE_DIR}/checkpoint/cnn.pt')
+    if pretrained:
+        load_model(cnn_net, f'{checkpoint_prefix("cnn")}.pt')
+    cnn_net.eval()
     return cnn_net
 
 
-def load_transformer():
+def load_transformer(pretrained=True):
     logging.warning(f"load_transformer")
-    vocab_size = 388+3
-    d_model = 256
-    ffn_l1_size = 512
-    ffn_l2_size = d_model
-    num_heads = 8
-    num_layers = 8
-    dropout = 0.1
-    decoder = TransformerDecoder(vocab_size, d_model, ffn_l1_size, ffn_l2_size, num_heads, num_layers, dropout, device=device)
-    transformer_net = Transformer(decoder).to(device)
-    load_model(transformer_net, f'{BASE_DIR}/checkpoint/transformer.pt')
+    hparams = model_hparams("transformer")
+    decoder = TransformerDecoder(**hparams, device=device)
+    transformer_net = Transformer(decoder, window=TRANSFORMER_WINDOW or None).to(device)
+    if pretrained:
+        load_model(transformer_net, f'{checkpoint_prefix("transformer")}.pt')
+    transformer_net.eval()
     return transformer_net
 
 
-def load_vae():
+def load_vae(pretrained=True):
     logging.warning(f"load_vae")
-    vocab_size = 388+3
-    embedding_dim = 256
-    hidden_size = 512
-    num_layers = 3
-    latent_dim = 64
-    vae_net = VAE(vocab_size, embedding_dim, hidden_size, num_layers, latent_dim).to(device)
-    load_model(vae_net, f'{BASE_DIR}/checkpoint/vae.pt')
+    hparams = model_hparams("vae")
+    vae_net = VAE(**hparams).to(device)
+    if pretrained:
+        load_model(vae_net, f'{checkpoint_prefix("vae")}.pt')
+    vae_net.eval()
     return vae_net
 
 
-def load_gan():
+def load_gan(pretrained=True):
     logging.warning(f"load_gan")
-    vocab_size = 388+3
-    embedding_dim = 256
-    hidden_size = 512
-    num_layers = 3
-    latent_dim = 64
-    g_net = Generator(vocab_size, embedding_dim, hidden_size, num_layers, latent_dim).to(device)
-    load_model(g_net, f'{BASE_DIR}/checkpoint/generator.pt')
+    hparams = model_hparams("gan")
+    g_net = Generator(**hparams).to(device)
+    if pretrained:
+        load_model(g_net, f'{checkpoint_prefix("gan")}.pt')
+    g_net.eval()
     return g_net
+
+MODEL_LOADERS = {
+    "rnn": load_rnn,
+    "cnn": load_cnn,
+    "transformer": load_transformer,
+    "vae": load_vae,
+    "gan": load_gan,
+}
+
+MAX_LOADED_MODELS = int(os.environ.get("MAX_LOADED_MODELS", len(MODEL_LOADERS)))
+WARMUP_LENGTH = int(os.environ.get("WARMUP_LENGTH", 8))
+# serve dynamically quantized int8 models, see quantization.py
+QUANTIZED = os.environ.get("QUANTIZED", "0") == "1"
+# serve TorchScript-compiled decoders, see scripting.py; /segments and /generate/stream are then unavailable
+TORCHSCRIPT = os.environ.get("TORCHSCRIPT", "0") == "1"
+# draft model of speculative transformer decoding, e.g. "rnn", see model/speculative.py
+SPECULATIVE_DRAFT = os.environ.get("SPECULATIVE_DRAFT", "")
+SPECULATIVE_K = int(os.environ.get("SPECULATIVE_K", 4))
+# attention window of transformer generation in positions, 0 attends over the whole piece
+TRANSFORMER_WINDOW = int(os.environ.get("TRANSFORMER_WINDOW", 0))
+# bytes of prefix states cached per model, 0 turns the cache off, see model/prefix_cache.py
+PREFIX_CACHE_MEMORY = int(os.environ.get("PREFIX_CACHE_MEMORY", 64 * 2**20))
+PREFIX_CACHE_MODELS = ("rnn", "vae", "gan", "transformer")
+
+
+def load_speculative(loader, draft_loader, k=SPECULATIVE_K):
+    logging.warning(f"load_speculative")
+    return SpeculativeModel(loader(), draft_loader(), k).eval()
+
+
+def with_prefix_cache(loader, budget=PREFIX_CACHE_MEMORY):
+    model = loader()
+    model.prefix_cache = PrefixCache(budget)
+    return model
+
+
+def serving_loaders(quantized=QUANTIZED, torchscript=TORCHSCRIPT, speculative_draft=SPECULATIVE_DRAFT,
+                    prefix_cache_memory=PREFIX_CACHE_MEMORY):
+    loaders = {}
+    if torchscript:
+        logging.warning(f"TorchScript decoders: /segments, /generate/stream and the prefix cache are not available")
+    for name, loader in MODEL_LOADERS.items():
+        if quantized:
+            loader = functools.partial(load_quantized, name, loader, checkpoint_prefix(name))
+        # compiled decoders prime inside the compiled loop
+        if prefix_cache_memory > 0 and name in PREFIX_CACHE_MODELS and not torchscript:
+            loader = functools.partial(with_prefix_cache, loader, prefix_cache_memory)
+        if torchscript:
+            window = TRANSFORMER_WINDOW or None if name == "transformer" else None
+            loader = functools.partial(load_scripted, name, loader, checkpoint_prefix(name), quantized, window)
+        loaders[name] = loader
+    if speculative_draft:
+        if torchscript:
+            logging.warning(f"speculative decoding is not available with TorchScript decoders")
+        elif TRANSFORMER_WINDOW:
+            logging.warning(f"speculative decoding is not available with a transformer window")
+        else:
+            loaders["transformer"] = functools.partial(load_speculative, loaders["transformer"],
+                                                       loaders[speculative_draft])
+    return loaders
+
+
+# models that draw latent noise, deterministic only with a seed
+LATENT_MODELS = {"vae", "gan"}
+
+# digest by the (path, size, mtime) of the hashed files
+_digests = {}
+
+
+def checkpoint_digest(name, quantized=QUANTIZED):
+    """sha256 of the weight files model `name` is served from, None without any: random weights differ per load"""
+    prefix = checkpoint_prefix(name)
+    if read_manifest(prefix) is not None:
+        paths = [f'{prefix}.json', weights_path(prefix)]
+    else:
+        paths = [f'{prefix}.pt']
+    if quantized:
+        paths.append(f'{prefix}.int8.pt')
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths or paths[0].endswith('.int8.pt'):
+        return None
+    stamp = tuple((path, os.path.getsize(path), os.path.getmtime(path)) for path in paths)
+    if stamp not in _digests:
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    digest.update(block)
+        _digests[stamp] = digest.hexdigest()
+    return _digests[stamp]
+
+
+def result_key(payload):
+    """
+    Key of the piece a GenerateRequest deterministically yields: its inputs, the checkpoint digest and
+    the serving mode. None when the result is not reproducible.
+    """
+    if payload.model in LATENT_MODELS and payload.seed is None:
+        return None
+    digest = checkpoint_digest(payload.model)
+    if digest is None:
+        return None
+    key = {
+        "model": payload.model,
+        "checkpoint": digest,
+        "serving": {"quantized": QUANTIZED, "torchscript": TORCHSCRIPT,
+                    "window": TRANSFORMER_WINDOW if payload.model == "transformer" else 0},
+        "length": payload.length,
+        "prefix": payload.prefix,
+        "duration": payload.duration,
+        "seed": payload.seed if payload.model in LATENT_MODELS else None,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class ModelRegistry:
+    """
+    Keeps loaded models resident between requests.
+
+    Models are built and loaded from their checkpoints on first use, warmed up with
+    a short forward pass and kept in LRU order; once more than `max_models` are
+    resident the least recently used one is dropped.
+    Model states: 'unloaded', 'loading', 'ready', 'failed'.
+    """
+
+    def __init__(self, loaders, max_models=MAX_LOADED_MODELS, warmup_length=WARMUP_LENGTH):
+        self.loaders = loaders
+        self.max_models = max(1, max_models)
+        self.warmup_length = warmup_length
+        self._models = OrderedDict()
+        self._states = {name: "unloaded" for name in loaders}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in loaders}
+        self._preloaded = False
+
+    def get(self, name):
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    return self._models[name]
+                self._states[name] = "loading"
+            try:
+                model = self.loaders[name]()
+                self._warmup(model)
+            except Exception:
+                with self._lock:
+                    self._states[name] = "failed"
+                raise
+            with self._lock:
+                self._models[name] = model
+                self._states[name] = "ready"
+                while len(self._models) > self.max_models:
+                    evicted, _ = self._models.popitem(last=False)
+                    self._states[evicted] = "unloaded"
+                    logging.warning(f"model {evicted} evicted")
+            return model
+
+    def preload(self, names=None):
+        names = list(self.loaders) if names is None else names
+        for name in names[:self.max_models]:
+            self.get(name)
+        self._preloaded = True
+
+    def _warmup(self, model):
+        if self.warmup_length < 2:
+            return
+        primer = torch.full((1, 1), bos_token).to(device)
+        valid_len = torch.full((1,), self.warmup_length).to(device)
+        with torch.no_grad():
+            model.predict(primer, valid_len)
+
+    @property
+    def ready(self):
+        return self._preloaded
+
+    def status(self):
+        with self._lock:
+            status = {
+                "ready": self.ready,
+                "resident": list(self._models),
+                "models": dict(self._states),
+            }
+            speculative = {name: model.acceptance_rate for name, model in self._models.items()
+                           if isinstance(model, SpeculativeModel)}
+            if speculative:
+                status["acceptance_rate"] = speculative
+            prefix_caches = {name: getattr(model, "model", model).prefix_cache.stats()
+                             for name, model in self._models.items()
+                             if hasattr(getattr(model, "model", model), "prefix_cache")}
+            if prefix_caches:
+                status["prefix_cache"] = prefix_caches
+            return status
+
+
+registry = ModelRegistry(serving_loaders())
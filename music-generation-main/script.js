@@ -5,6 +5,79 @@ const generateButton = document.querySelector("#generate");
 const statusParagraph = document.querySelector("#status");
 const midiPlayer = document.querySelector("#midi");
 const downloadAnchor = document.querySelector("#download");
+const streamCheckbox = document.querySelector("#stream");
+
+// seconds between the first notes arriving and their playback
+const STREAM_DELAY = 0.5;
+
+// Plays the notes of /generate/stream as they arrive, then hands the whole piece to the player
+async function playStream(response) {
+  await Tone.start();
+  const synth = new Tone.PolySynth(Tone.Synth).toDestination();
+  const notes = [];
+  let startTime = null;
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let pending = "";
+  // only an end event finishes the piece, an error event or a closed connection leaves it cut short
+  let ended = false;
+  while (!ended) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    pending += decoder.decode(value, { stream: true });
+    const blocks = pending.split("\n\n");
+    pending = blocks.pop();
+    for (const block of blocks) {
+      const lines = block.split("\n");
+      const event = lines[0].slice("event: ".length);
+      const data = JSON.parse(lines[1].slice("data: ".length));
+      if (event === "error") {
+        await reader.cancel();
+        synth.releaseAll();
+        statusParagraph.innerText = `Error ${data.status}: ${data.detail}`;
+        return;
+      }
+      if (event === "end") {
+        ended = true;
+        break;
+      }
+      if (event !== "notes" || data.length === 0) continue;
+      if (startTime === null) {
+        startTime = Tone.now() + STREAM_DELAY;
+        statusParagraph.innerText = "Playing...";
+      }
+      for (const note of data) {
+        notes.push(note);
+        const time = Math.max(startTime + note.start, Tone.now());
+        synth.triggerAttackRelease(
+          Tone.Frequency(note.pitch, "midi").toFrequency(),
+          note.end - note.start,
+          time,
+          note.velocity / 127
+        );
+      }
+    }
+  }
+  if (!ended) {
+    synth.releaseAll();
+    statusParagraph.innerText = "Error: the stream closed before the piece was finished";
+    return;
+  }
+  const sequence = {
+    notes: notes.map((note) => ({
+      pitch: note.pitch,
+      velocity: note.velocity,
+      startTime: note.start,
+      endTime: note.end,
+    })),
+    totalTime: Math.max(0, ...notes.map((note) => note.end)),
+  };
+  let blob = new Blob([core.sequenceProtoToMidi(sequence)], { type: "audio/midi" });
+  let blobUrl = URL.createObjectURL(blob);
+  statusParagraph.innerText = "Success!";
+  midiPlayer.setAttribute("src", blobUrl);
+  downloadAnchor.setAttribute("href", blobUrl);
+}
 
 generateButton.addEventListener("click", async (e) => {
   e.preventDefault();
@@ -13,6 +86,9 @@ generateButton.addEventListener("click", async (e) => {
   midiPlayer.setAttribute("src", "data:,");
   downloadAnchor.setAttribute("href", "#");
   let url = "https://music-generation-24psxym5la-uc.a.run.app/generate";
+  if (streamCheckbox.checked) {
+    url += "/stream";
+  }
   let body = {
     method: "POST",
     mode: "cors",
@@ -29,7 +105,9 @@ generateButton.addEventListener("click", async (e) => {
   console.log(url, body);
   try {
     let response = await fetch(url, body);
-    if (response.ok) {
+    if (response.ok && streamCheckbox.checked) {
+      await playStream(response);
+    } else if (response.ok) {
       let buffer = await response.arrayBuffer();
       let blob = new Blob([buffer], { type: "audio/midi" });
       let blobUrl = URL.createObjectURL(blob);
@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+sys.path.insert(0, APP_DIR)
+
+# nothing is written next to the checkpoints or the result cache of a deployment
+os.environ.setdefault('RESULT_CACHE_DISK', '0')
+os.environ.setdefault('RESULT_CACHE_DIR', tempfile.mkdtemp())
+os.environ.setdefault('WARMUP_LENGTH', '0')
+
+import pytest
+import torch
+
+from model import pad_token
+from model.rnn import RNN
+from model.cnn import WaveNet, CNN
+from model.transformer import TransformerDecoder, Transformer
+from model.vae import VAE
+from model.gan import Generator
+
+VOCAB_SIZE = 388 + 3
+
+
+def build_model(name):
+    """A small model with seeded random weights, in eval mode"""
+    torch.manual_seed(0)
+    if name == 'rnn':
+        model = RNN(VOCAB_SIZE, 16, 32, 2)
+    elif name == 'cnn':
+        model = CNN(WaveNet(VOCAB_SIZE, 16, 16, 4, 1, 2))
+    elif name == 'transformer':
+        model = Transformer(TransformerDecoder(VOCAB_SIZE, 32, 64, 32, 4, 2, 0.1, device=torch.device('cpu')))
+    elif name == 'vae':
+        model = VAE(VOCAB_SIZE, 16, 32, 2, 8)
+    else:
+        model = Generator(VOCAB_SIZE, 16, 32, 2, 8)
+    return model.eval()
+
+
+@pytest.fixture(params=['rnn', 'cnn', 'transformer', 'vae', 'gan'])
+def any_model(request):
+    return request.param, build_model(request.param)
+
+
+def batch(prefixes, lengths):
+    """(target, valid_len, prefix_len) of right-padded prefixes"""
+    target = torch.full((len(prefixes), max(map(len, prefixes))), pad_token)
+    for i, prefix in enumerate(prefixes):
+        target[i, :len(prefix)] = torch.tensor(prefix)
+    return target, torch.tensor(lengths), torch.tensor([len(prefix) for prefix in prefixes])
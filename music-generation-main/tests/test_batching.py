@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+import main
+import util
+from batching import MicroBatcher
+from conftest import build_model
+from model.transformer import MAX_POSITIONS
+from processor import decode_midi
+from util import GenerateRequest, generate_buffer, generate_buffers, midi_buffer
+
+PREFIXES = [[1, 60, 300], [1, 60, 300, 188, 70, 256], [1]]
+LENGTHS = [20, 12, 30]
+
+
+class FakeExecutor:
+    """Runs a batch in place, returning the row index as its MIDI bytes"""
+
+    def __init__(self):
+        self.batches = []
+        self.reserved = 0
+
+    def reserve(self, requests=1):
+        self.reserved += requests
+
+    async def run(self, fn, name, lengths, prefixes, durations, seeds, requests=1, reserved=False):
+        assert reserved and requests == len(prefixes)
+        self.reserved -= requests
+        self.batches.append(prefixes)
+        return [(None, bytes([i])) for i in range(len(prefixes))]
+
+
+@pytest.mark.parametrize('name', ['rnn', 'cnn', 'transformer', 'vae', 'gan'])
+def test_batch_rows_match_solo_runs(name):
+    model = build_model(name)
+    seeds = [3, 4, 5] if name in ('vae', 'gan') else [None] * 3
+    batched = generate_buffers(model, LENGTHS, PREFIXES, [None] * 3, seeds)
+    for i in range(3):
+        _, solo = generate_buffer(model, LENGTHS[i], PREFIXES[i], None, seeds[i])
+        assert batched[i][1].getvalue() == solo.getvalue()
+
+
+def test_request_constraints():
+    with pytest.raises(ValidationError):
+        GenerateRequest(model='rnn', length=20, prefix=[1, 391])
+    with pytest.raises(ValidationError):
+        GenerateRequest(model='rnn', length=0, prefix=[1])
+
+
+@pytest.mark.parametrize('length, prefix', [(5, []), (2, [1, 60]), (3, [1, 60, 300])])
+def test_unfit_request_is_refused_with_422(length, prefix):
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(main.generate(GenerateRequest(model='rnn', length=length, prefix=prefix)))
+    assert raised.value.status_code == 422
+
+
+def test_bad_request_does_not_fail_its_batch():
+    executor = FakeExecutor()
+
+    async def run():
+        batcher = MicroBatcher(executor, window=0.01, max_batch_size=8)
+        return await asyncio.gather(batcher.submit('rnn', 10, [1, 60]), batcher.submit('rnn', 10, []),
+                                    batcher.submit('rnn', 10, [1, 70]), return_exceptions=True)
+
+    first, bad, last = asyncio.run(run())
+    assert isinstance(bad, ValueError)
+    assert first[1].getvalue() == b'\x00' and last[1].getvalue() == b'\x01'
+    assert executor.batches == [[[1, 60], [1, 70]]]
+    assert executor.reserved == 0
+
+
+def test_batch_is_flushed_when_full():
+    executor = FakeExecutor()
+
+    async def run():
+        # a window no test waits for
+        batcher = MicroBatcher(executor, window=60, max_batch_size=2)
+        return await asyncio.gather(batcher.submit('rnn', 10, [1, 60]), batcher.submit('rnn', 10, [1, 70]))
+
+    assert len(asyncio.run(run())) == 2
+    assert len(executor.batches) == 1
+
+
+def test_is_mid_returns_the_generated_notes_without_reading_the_file(monkeypatch):
+    tokens = [1, 60, 300, 259 + 20, 188, 350, 63, 256 + 3]
+
+    async def submit(name, length, prefix, duration=None, seed=None):
+        return midi_buffer(tokens[1:3], tokens[3:])
+
+    monkeypatch.setattr(main, 'result_key', lambda payload: None)
+    monkeypatch.setattr(main.batcher, 'submit', submit)
+    mid = asyncio.run(main.generate(GenerateRequest(model='rnn', length=20, prefix=tokens[:3], is_mid=True)))
+    # a file read back has its times rounded to ticks
+    expected = decode_midi([token - 3 for token in tokens[1:]]).instruments[0].notes
+    assert expected
+    assert [(n.pitch, n.start, n.end) for n in mid.instruments[0].notes] == [(n.pitch, n.start, n.end) for n in expected]
+
+
+def test_too_long_request_is_refused_with_422():
+    length = util.MAX_LENGTH + 1
+    with pytest.raises(HTTPException) as raised:
+        asyncio.run(main.generate(GenerateRequest(model='rnn', length=length, prefix=[1])))
+    assert raised.value.status_code == 422
+
+
+def test_transformer_is_bound_by_its_positional_encoding(monkeypatch):
+    monkeypatch.setattr(util, 'MAX_LENGTH', 10 * MAX_POSITIONS)
+    monkeypatch.setattr(util, 'TRANSFORMER_WINDOW', 0)
+    with pytest.raises(ValueError):
+        util.check_generation(MAX_POSITIONS + 1, [1], 'transformer')
+    util.check_generation(MAX_POSITIONS + 1, [1], 'rnn')
+    monkeypatch.setattr(util, 'TRANSFORMER_WINDOW', 64)
+    util.check_generation(MAX_POSITIONS + 1, [1], 'transformer')
+
+
+def test_too_long_request_does_not_fail_its_batch():
+    executor = FakeExecutor()
+
+    async def run():
+        batcher = MicroBatcher(executor, window=0.01, max_batch_size=8)
+        return await asyncio.gather(batcher.submit('transformer', 10, [1, 60]),
+                                    batcher.submit('transformer', util.MAX_LENGTH + 1, [1, 70]),
+                                    return_exceptions=True)
+
+    valid, too_long = asyncio.run(run())
+    assert isinstance(too_long, ValueError)
+    assert valid[1].getvalue() == b'\x00'
+    assert executor.batches == [[[1, 60]]] and executor.reserved == 0
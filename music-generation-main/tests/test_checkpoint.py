@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from checkpoint import convert, load_weights, read_manifest
+from conftest import build_model
+
+HPARAMS = {"embedding_dim": 16, "hidden_size": 32, "num_layers": 2}
+
+
+def save_training_checkpoint(directory):
+    model = build_model('rnn')
+    torch.save({'model_state_dict': model.state_dict(), 'loss_list': [1.0]}, directory / 'rnn.pt')
+    return model
+
+
+def test_converted_weights_load_back(tmp_path):
+    model = save_training_checkpoint(tmp_path)
+    manifest = convert('rnn', str(tmp_path), HPARAMS)
+    assert manifest['hparams']['hidden_size'] == 32
+    assert read_manifest(str(tmp_path / 'rnn')) == manifest
+    state_dict = load_weights(str(tmp_path / 'rnn'))
+    for key, tensor in model.state_dict().items():
+        assert torch.equal(state_dict[key], tensor)
+
+
+def test_hparams_that_do_not_match_the_checkpoint_are_refused(tmp_path):
+    save_training_checkpoint(tmp_path)
+    with pytest.raises(ValueError, match='hidden_size'):
+        convert('rnn', str(tmp_path), {**HPARAMS, "hidden_size": 64})
+    assert read_manifest(str(tmp_path / 'rnn')) is None
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from coalescing import SingleFlight
+
+
+def test_identical_calls_in_flight_run_once():
+    flights = SingleFlight()
+    calls = []
+
+    async def generate(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key * 2
+
+    async def run():
+        return await asyncio.gather(flights.run('a', generate, 'a'), flights.run('a', generate, 'a'),
+                                    flights.run('b', generate, 'b'))
+
+    assert asyncio.run(run()) == ['aa', 'aa', 'bb']
+    assert calls == ['a', 'b']
+    assert flights.stats()['coalesced'] == 1 and flights.stats()['in_flight'] == 0
+
+
+def test_followers_get_the_exception_of_the_call():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('bad')
+
+    async def run():
+        return await asyncio.gather(flights.run('a', fail), flights.run('a', fail), return_exceptions=True)
+
+    assert [type(result) for result in asyncio.run(run())] == [ValueError, ValueError]
+
+
+def test_cancelled_leader_does_not_cancel_the_others():
+    flights = SingleFlight()
+
+    async def generate():
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    async def run():
+        leader = asyncio.ensure_future(flights.run('a', generate))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.run('a', generate))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == 'done'
@@ -0,0 +1,44 @@
+import logging
+import shutil
+
+import numpy as np
+
+from corpus import build, load_corpus, summary
+from processor import encode_midi
+from model import bos_token, eos_token
+from test_processor import random_midi
+
+
+def expected_tokens(path):
+    return [bos_token] + [event + 3 for event in encode_midi(str(path))] + [eos_token]
+
+
+def test_corpus_holds_the_encoded_files_and_is_reused_on_a_rebuild(tmp_path, caplog):
+    folder, directory = tmp_path / 'midi', tmp_path / 'corpus'
+    (folder / 'nested').mkdir(parents=True)
+    (folder / 'nested' / 'a.mid').write_bytes(random_midi(np.random.default_rng(0)))
+    (folder / 'b.midi').write_bytes(b'not a midi file')
+
+    with caplog.at_level(logging.WARNING):
+        manifest = build(str(folder), str(directory), workers=2)
+    assert [entry['path'] for entry in manifest['files']] == ['b.midi', 'nested/a.mid']
+    corrupt, valid = manifest['files']
+    assert corrupt['error'] is not None and corrupt['tokens'] == 0
+    assert valid['error'] is None and summary(manifest)['failed'] == 1
+
+    tokens, offsets, _ = load_corpus(str(directory))
+    assert offsets.tolist() == [0, 0, valid['tokens']]
+    assert tokens[offsets[1]:offsets[2]].tolist() == expected_tokens(folder / 'nested' / 'a.mid')
+
+    # one more file: the two already encoded are copied over, the new one is encoded
+    shutil.copy(folder / 'nested' / 'a.mid', folder / 'c.mid')
+    (folder / 'd.mid').write_bytes(random_midi(np.random.default_rng(1)))
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        rebuilt = build(str(folder), str(directory), workers=2)
+    assert '4 files, 1 encoded, 3 unchanged' in caplog.text
+    assert rebuilt['files'][0] == corrupt
+
+    tokens, offsets, _ = load_corpus(str(directory))
+    for i, entry in enumerate(rebuilt['files'][1:], start=1):
+        assert tokens[offsets[i]:offsets[i + 1]].tolist() == expected_tokens(folder / entry['path'])
@@ -0,0 +1,113 @@
+import pytest
+import torch
+from pydantic import ValidationError
+
+from conftest import VOCAB_SIZE, batch, build_model
+from model.decoding import decode, limit_duration
+from util import GenerateRequest
+
+NOTE_ON = 3 + 60
+# 10 ticks, a tenth of a second
+SHIFT = 3 + 256 + 9
+
+
+class ScheduleModel:
+    """Predicts a note_on then a 10-tick time_shift, whatever the tokens, to reach durations at known positions"""
+
+    def _logits(self, positions):
+        logits = torch.zeros(len(positions), VOCAB_SIZE)
+        logits[torch.arange(len(positions)), torch.where(positions % 2 == 0, NOTE_ON, SHIFT)] = 1
+        return logits
+
+    def prime(self, tokens):
+        positions = torch.full((tokens.shape[0],), tokens.shape[1])
+        return self._logits(positions), positions
+
+    def step(self, tokens, state, t):
+        return self._logits(state + 1), state + 1
+
+    def select_state(self, state, index):
+        return state[index]
+
+
+PREFIXES = [[1, NOTE_ON, SHIFT], [1, SHIFT, SHIFT, NOTE_ON, SHIFT], [1]]
+
+
+@pytest.mark.parametrize('prefixes', [PREFIXES, PREFIXES[:2]])
+@pytest.mark.parametrize('seconds', [0.05, 0.1, 0.2, 0.25, 0.45])
+def test_decode_stops_where_limit_duration_cuts(prefixes, seconds):
+    target, valid_len, prefix_len = batch(prefixes, [16] * len(prefixes))
+    duration = torch.full((len(prefixes),), seconds)
+    stopped = decode(ScheduleModel(), target, valid_len, prefix_len, duration)
+    cut = limit_duration(decode(ScheduleModel(), target, valid_len, prefix_len), prefix_len, duration)
+    assert torch.equal(stopped, cut)
+
+
+def test_prefix_reaching_the_duration_generates_nothing():
+    target, valid_len, prefix_len = batch([PREFIXES[1]], [16])
+    outputs = decode(ScheduleModel(), target, valid_len, prefix_len, torch.tensor([0.25]))
+    assert outputs[0, :4].tolist() == PREFIXES[1][1:]
+    assert (outputs[0, 4:] == 0).all()
+
+
+@pytest.mark.parametrize('duration', [0, -1.0])
+def test_duration_must_be_positive(duration):
+    with pytest.raises(ValidationError):
+        GenerateRequest(model='rnn', length=8, prefix=[1], duration=duration)
+
+
+def cut_at_eos(outputs, prefix_len):
+    """Rows of outputs padded after their first eos past the prefix, as the decoding engine leaves them"""
+    positions = torch.arange(1, outputs.shape[1] + 1).unsqueeze(0)
+    eos = (outputs == 2) & (positions >= prefix_len.unsqueeze(1))
+    after = (eos.cumsum(dim=1) - eos.long()) > 0
+    return outputs.masked_fill(after, 0)
+
+
+@pytest.mark.parametrize('name', ['cnn', 'transformer'])
+def test_cached_decoding_matches_rerunning_the_whole_sequence(name):
+    model = build_model(name)
+    target, valid_len, prefix_len = batch([[1, 60, 300, 188], [1, 70], [1, 62, 270]], [30, 18, 40])
+    with torch.no_grad():
+        cached = model.predict(target, valid_len, prefix_len)
+        rerun = model.predict(target, valid_len, prefix_len, use_cache=False)
+    rerun = cut_at_eos(rerun, prefix_len)
+    for i in range(3):
+        assert torch.equal(cached[i, :valid_len[i] - 1], rerun[i, :valid_len[i] - 1])
+
+
+class EosModel:
+    """Predicts eos at the position `stops[row]` of each row, note_on elsewhere, and records its batch sizes"""
+
+    def __init__(self, stops):
+        self.stops = torch.tensor(stops)
+        self.batch_sizes = []
+
+    def _logits(self, positions, rows):
+        logits = torch.zeros(len(rows), VOCAB_SIZE)
+        logits[torch.arange(len(rows)), torch.where(positions == self.stops[rows], 2, NOTE_ON)] = 1
+        return logits
+
+    def prime(self, tokens):
+        positions, rows = torch.full((tokens.shape[0],), tokens.shape[1]), torch.arange(tokens.shape[0])
+        return self._logits(positions, rows), (positions, rows)
+
+    def step(self, tokens, state, t):
+        positions, rows = state
+        self.batch_sizes.append(len(rows))
+        return self._logits(positions + 1, rows), (positions + 1, rows)
+
+    def select_state(self, state, index):
+        return state[0][index], state[1][index]
+
+
+def test_rows_stop_at_eos_and_leave_the_batch():
+    model = EosModel([4, 8, 30])
+    target, valid_len, prefix_len = batch([[1, 60], [1, 60], [1, 60]], [12, 12, 12])
+    outputs = decode(model, target, valid_len, prefix_len)
+    for i, stop in enumerate([4, 8]):
+        assert outputs[i, stop - 1] == 2 and (outputs[i, stop:] == 0).all()
+        assert (outputs[i, 1:stop - 1] == NOTE_ON).all()
+    assert (outputs[2, 1:] == NOTE_ON).all()
+    # a row is dropped from the steps after the one that consumed its eos
+    assert model.batch_sizes == [3] * 3 + [2] * 4 + [1] * 2
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+import pytest
+
+import executor as executor_module
+from executor import InferenceExecutor, QueueFullError
+
+
+def test_queue_counts_requests():
+    executor = InferenceExecutor("thread", workers=1, queue_size=3)
+    executor.reserve(2)
+    executor.reserve()
+    assert executor.full
+    with pytest.raises(QueueFullError):
+        executor.reserve()
+    executor.shutdown()
+
+
+def test_requests_wait_behind_running_jobs_up_to_queue_size():
+    executor = InferenceExecutor("thread", workers=1, queue_size=3)
+    release = threading.Event()
+
+    async def run():
+        running = asyncio.ensure_future(executor.run(release.wait))
+        await asyncio.sleep(0.01)
+        batch = asyncio.ensure_future(executor.run(sum, [1, 2], requests=2))
+        single = asyncio.ensure_future(executor.run(sum, [3]))
+        await asyncio.sleep(0.01)
+        assert executor.status()["running"] == 1 and executor.status()["waiting"] == 3
+        with pytest.raises(QueueFullError):
+            await executor.run(sum, [4])
+        release.set()
+        return await asyncio.gather(running, batch, single)
+
+    assert asyncio.run(run()) == [True, 3, 3]
+    assert executor.status()["waiting"] == 0 and executor.status()["running"] == 0
+    executor.shutdown()
+
+
+def test_failed_preload_is_reported(monkeypatch):
+    def fail():
+        raise RuntimeError("no weights")
+
+    monkeypatch.setattr(executor_module, "preload_models", fail)
+    executor = InferenceExecutor("thread", workers=1, queue_size=1)
+    asyncio.run(executor.start())
+    status = executor.status()
+    assert not status["ready"]
+    assert status["error"] == "RuntimeError: no weights"
+    executor.shutdown()
+
+
+def test_batcher_reserves_requests_as_they_arrive():
+    from batching import MicroBatcher
+
+    executor = InferenceExecutor("thread", workers=1, queue_size=2)
+
+    async def run():
+        batcher = MicroBatcher(executor, window=60, max_batch_size=8)
+        held = [asyncio.ensure_future(batcher.submit("rnn", 10, [1, 60])) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await batcher.submit("rnn", 10, [1, 60])
+        for future in held:
+            future.cancel()
+
+    asyncio.run(run())
+    executor.shutdown()
@@ -0,0 +1,95 @@
+import pytest
+import torch
+
+from conftest import batch, build_model
+from model.decoding import decode
+from model.prefix_cache import PrefixCache
+
+PREFIXES = [[1, 60, 300, 188], [1, 70, 280, 190, 60]]
+LONGER = [[1, 60, 300, 188, 300, 62], [1, 70, 280, 190, 60, 256]]
+
+
+def cached(name, budget=2**20):
+    model = build_model(name)
+    model.prefix_cache = PrefixCache(budget)
+    return model
+
+
+def prime(model, prefixes, seeds=None):
+    tokens = torch.tensor(prefixes)
+    with torch.no_grad():
+        if getattr(model, 'prefix_cache', None) is not None:
+            return model.prefix_cache.prime(model, tokens, seeds)
+        return model.prime(tokens) if seeds is None else model.prime(tokens, seeds)
+
+
+@pytest.mark.parametrize('name', ['rnn', 'transformer', 'vae', 'gan'])
+def test_resumed_rows_match_a_cold_prime_up_to_float_rounding(name):
+    model = cached(name)
+    seeds = [3, 4] if name in ('vae', 'gan') else None
+    prime(model, [PREFIXES[0], PREFIXES[0]], seeds)
+    # one row resumes within its prefix, one misses
+    prefixes = [LONGER[0], [1, 70, 280, 190, 60, 256]]
+    logits, _ = prime(model, prefixes, seeds)
+    assert model.prefix_cache.stats()['hits'] == 1
+    cold, _ = prime(build_model(name), prefixes, seeds)
+    assert torch.allclose(logits, cold, atol=1e-5)
+
+
+def test_decoding_through_the_cache_gives_the_outputs_of_a_cold_model():
+    model = cached('transformer')
+    target, valid_len, prefix_len = batch(LONGER, [20, 20])
+    with torch.no_grad():
+        decode(model, *batch(PREFIXES, [20, 20]))
+        warm = decode(model, target, valid_len, prefix_len)
+        cold = decode(build_model('transformer'), target, valid_len, prefix_len)
+    assert model.prefix_cache.stats()['reused_tokens'] > 0
+    assert torch.equal(warm, cold)
+
+
+class CountingModel:
+    """Counts the select_state copies of a model"""
+
+    def __init__(self, model):
+        self.model = model
+        self.copies = 0
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def select_state(self, state, index):
+        self.copies += 1
+        return self.model.select_state(state, index)
+
+
+def test_whole_prefix_hits_are_not_copied_nor_inserted_again():
+    model = CountingModel(build_model('transformer'))
+    model.prefix_cache = PrefixCache(2**20)
+    prime(model, PREFIXES[:1])
+    entries, size, copies = model.prefix_cache.stats()['entries'], model.prefix_cache.size, model.copies
+    logits, state = prime(model, PREFIXES[:1])
+    assert model.copies == copies
+    assert model.prefix_cache.stats()['entries'] == entries and model.prefix_cache.size == size
+    # the steps decoding takes do not reach the cached state
+    model.step(torch.tensor([60]), state, len(PREFIXES[0]))
+    again, _ = prime(model, PREFIXES[:1])
+    assert torch.equal(logits, again)
+
+
+def test_least_recently_used_prefixes_are_dropped_past_the_budget():
+    model = cached('rnn')
+    prime(model, PREFIXES[:1])
+    entry = model.prefix_cache.size
+    model.prefix_cache.budget = 2 * entry
+    for token in (61, 62, 63):
+        prime(model, [PREFIXES[0][:-1] + [token]])
+    stats = model.prefix_cache.stats()
+    assert stats['entries'] == 2 and stats['bytes'] <= stats['budget']
+    prime(model, [PREFIXES[0][:-1] + [63]])
+    assert model.prefix_cache.stats()['hits'] == 1
+
+
+def test_rows_of_latent_models_without_a_seed_are_not_cached():
+    model = cached('vae')
+    prime(model, LONGER)
+    assert model.prefix_cache.stats()['entries'] == 0
@@ -0,0 +1,118 @@
+from io import BytesIO
+
+import numpy as np
+import pretty_midi
+import pytest
+
+from processor import (RANGE_NOTE_ON, START_IDX, RANGE_VEL, Event, EventDecoder, _control_preprocess, _decode_notes,
+                       _divide_note, _event_seq2snote_seq, _make_time_sift_events, _merge_note, _note_preprocess,
+                       _snote2events, decode_midi, decode_midi_bytes, encode_midi, encode_pretty_midi, note_arrays,
+                       notes_midi)
+
+EVENTS = START_IDX['velocity'] + RANGE_VEL
+
+
+def _decode_notes_reference(idx_array):
+    """The notes of an event sequence, one object per event"""
+    event_sequence = [Event.from_int(idx) for idx in idx_array]
+    snote_seq = _event_seq2snote_seq(event_sequence)
+    note_seq = _merge_note(snote_seq)
+    note_seq.sort(key=lambda x:x.start)
+    return note_seq
+
+
+def _encode_reference(mid):
+    """The tokens of a PrettyMIDI, one object per note and event. Note ends of sustained notes are changed in place."""
+    events = []
+    notes = []
+
+    for inst in mid.instruments:
+        inst_notes = inst.notes
+        ctrls = _control_preprocess([ctrl for ctrl in inst.control_changes if ctrl.number == 64])
+        notes += _note_preprocess(ctrls, inst_notes)
+
+    dnotes = _divide_note(notes)
+    dnotes.sort(key=lambda x: x.time)
+    cur_time = 0
+    cur_vel = 0
+    for snote in dnotes:
+        events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
+        events += _snote2events(snote=snote, prev_vel=cur_vel)
+        cur_time = snote.time
+        cur_vel = snote.velocity
+
+    return [e.to_int() for e in events]
+
+
+def random_midi(rng):
+    """MIDI file bytes with overlapping notes and sustain pedal controls, some pressed after the last note"""
+    mid = pretty_midi.PrettyMIDI()
+    for program in range(rng.integers(1, 3)):
+        inst = pretty_midi.Instrument(program)
+        for _ in range(rng.integers(0, 300)):
+            start = round(float(rng.uniform(0, 60)), int(rng.integers(1, 4)))
+            end = start + round(float(rng.exponential(1.0)), 2) + 0.01
+            inst.notes.append(pretty_midi.Note(int(rng.integers(1, 128)), int(rng.integers(40, 50)), start, end))
+        times = np.sort(rng.uniform(0, 70, rng.integers(0, 80)))
+        for time in times.tolist():
+            inst.control_changes.append(pretty_midi.ControlChange(64, int(rng.choice([0, 30, 64, 127])), time))
+        mid.instruments.append(inst)
+    buffer = BytesIO()
+    mid.write(buffer)
+    return buffer.getvalue()
+
+
+def random_events(rng, length, few_pitches):
+    """A random event sequence, over a few pitches only so that notes overlap and note_offs repeat"""
+    if few_pitches:
+        pitches = rng.integers(0, RANGE_NOTE_ON, 3)
+        choices = np.concatenate([pitches, pitches + RANGE_NOTE_ON, np.arange(START_IDX['time_shift'], EVENTS)])
+        return rng.choice(choices, rng.integers(0, length)).tolist()
+    return rng.integers(0, EVENTS, rng.integers(0, length)).tolist()
+
+
+def as_tuples(notes):
+    return [(note.velocity, note.pitch, note.start, note.end) for note in notes]
+
+
+@pytest.mark.parametrize('few_pitches', [False, True])
+@pytest.mark.parametrize('seed', range(20))
+def test_decoded_notes_match_the_reference(seed, few_pitches):
+    idx_array = random_events(np.random.default_rng(seed), 2000, few_pitches)
+    assert as_tuples(_decode_notes(idx_array)) == as_tuples(_decode_notes_reference(idx_array))
+
+
+def test_event_decoder_pushes_the_notes_of_the_sequence():
+    idx_array = random_events(np.random.default_rng(0), 2000, True)
+    decoder = EventDecoder()
+    pushed = [note for note in map(decoder.push, idx_array) if note is not None]
+    assert sorted(as_tuples(pushed), key=lambda note: note[2]) == as_tuples(_decode_notes(idx_array))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_midi_bytes_are_the_file_decode_midi_writes(seed):
+    idx_array = random_events(np.random.default_rng(seed), 2000, seed % 2 == 1)
+    buffer = BytesIO()
+    decode_midi(idx_array, buffer)
+    assert decode_midi_bytes(idx_array) == buffer.getvalue()
+
+
+def test_notes_midi_is_the_midi_decode_midi_builds():
+    idx_array = random_events(np.random.default_rng(0), 2000, False)
+    built, decoded = notes_midi(note_arrays(idx_array)), decode_midi(idx_array)
+    assert [(inst.program, inst.name) for inst in built.instruments] == [(inst.program, inst.name) for inst in decoded.instruments]
+    assert as_tuples(built.instruments[0].notes) == as_tuples(decoded.instruments[0].notes)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_encoded_tokens_match_the_reference(seed):
+    data = random_midi(np.random.default_rng(seed))
+    assert encode_midi(BytesIO(data)) == _encode_reference(pretty_midi.PrettyMIDI(BytesIO(data)))
+
+
+def test_encoding_a_decoded_piece_gives_back_its_notes():
+    idx_array = random_events(np.random.default_rng(1), 2000, False)
+    mid = decode_midi(idx_array)
+    # times are sums of hundredths, added up in another order
+    rounded = lambda notes: [(v, p, round(start, 6), round(end, 6)) for v, p, start, end in as_tuples(notes)]
+    assert rounded(_decode_notes(encode_pretty_midi(mid))) == rounded(mid.instruments[0].notes)
@@ -0,0 +1,27 @@
+import torch
+
+from quantization import load_quantized
+from conftest import build_model
+
+
+def test_cached_artifact_is_loaded_without_the_float_weights(tmp_path):
+    prefix = str(tmp_path / 'rnn')
+    calls = []
+
+    def loader(pretrained=True):
+        calls.append(pretrained)
+        model = build_model('rnn')
+        if not pretrained:
+            # stands for the random initialization of an untrained model
+            for parameter in model.parameters():
+                torch.nn.init.normal_(parameter.data)
+        return model
+
+    saved = load_quantized('rnn', loader, prefix, save=True)
+    assert (tmp_path / 'rnn.int8.pt').exists()
+    loaded = load_quantized('rnn', loader, prefix)
+    assert calls == [True, False]
+
+    tokens = torch.randint(3, 391, (2, 8), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        assert torch.equal(saved.prime(tokens)[0], loaded.prime(tokens)[0])
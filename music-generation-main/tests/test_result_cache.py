@@ -0,0 +1,26 @@
+from result_cache import ResultCache
+
+
+def test_memory_tier_drops_the_least_recently_used_piece(tmp_path):
+    cache = ResultCache(memory_budget=10, disk_budget=0, directory=str(tmp_path))
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'
+    cache.put('c', b'1234')
+    assert cache.get('b') is None and cache.get('a') == b'1234' and cache.get('c') == b'1234'
+    assert cache.stats()['memory']['bytes'] == 8
+
+
+def test_disk_tier_outlives_the_process_and_is_promoted(tmp_path):
+    ResultCache(memory_budget=100, disk_budget=100, directory=str(tmp_path)).put('a', b'midi')
+    cache = ResultCache(memory_budget=100, disk_budget=100, directory=str(tmp_path))
+    assert cache.get('a') == b'midi' and cache.get('a') == b'midi'
+    assert cache.stats()['hits'] == {'memory': 1, 'disk': 1}
+
+
+def test_disk_tier_keeps_to_its_budget(tmp_path):
+    cache = ResultCache(memory_budget=0, disk_budget=8, directory=str(tmp_path))
+    for key in 'abc':
+        cache.put(key, b'1234')
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['b.mid', 'c.mid']
+    assert cache.get('a') is None and cache.stats()['disk']['bytes'] == 8
@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+import torch
+from fastapi import HTTPException
+
+import main
+import util
+from conftest import build_model
+from model.scripted import script_decoder
+from scripting import ScriptedModel
+from util import GenerateRequest, SegmentRequest, SteppingUnavailable, generate_segment
+
+
+def test_compiled_decoder_does_not_decode_segments():
+    model = ScriptedModel(torch.jit.script(script_decoder('rnn', build_model('rnn')).eval()))
+    with pytest.raises(SteppingUnavailable):
+        generate_segment(model, 4, [1, 60])
+
+
+@pytest.mark.parametrize('endpoint, payload', [
+    (main.start_segments, SegmentRequest(model='rnn', length=4, prefix=[1, 60])),
+    (main.generate_stream, GenerateRequest(model='rnn', length=4, prefix=[1, 60])),
+])
+def test_step_endpoints_answer_501_with_torchscript(monkeypatch, endpoint, payload):
+    monkeypatch.setattr(util, 'TORCHSCRIPT', True)
+    sessions = len(main.sessions)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(endpoint(payload))
+    assert error.value.status_code == 501 and 'TORCHSCRIPT' in error.value.detail
+    assert len(main.sessions) == sessions
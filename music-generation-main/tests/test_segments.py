@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+import torch
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+import main
+from conftest import batch, build_model
+from model.decoding import decode, decode_segment
+from util import ContinueRequest, SegmentRequest, generate_segment
+
+PREFIX = [1, 60, 300, 188]
+
+
+@pytest.mark.parametrize('name', ['rnn', 'cnn', 'transformer', 'vae', 'gan'])
+def test_segments_continue_the_piece_decode_gives(name):
+    model = build_model(name)
+    seed = 7 if name in ('vae', 'gan') else None
+    tokens, carry, finished = generate_segment(model, 5, PREFIX, seed=seed)
+    while not finished and len(tokens) < 20:
+        segment, carry, finished = generate_segment(model, 3, carry=carry)
+        tokens += segment
+    target, valid_len, prefix_len = batch([PREFIX], [len(PREFIX) + 20])
+    with torch.no_grad():
+        expected = decode(model, target, valid_len, prefix_len, seeds=[seed] if seed is not None else None)
+    assert tokens == expected[0, len(PREFIX) - 1:len(PREFIX) - 1 + len(tokens)].tolist()
+
+
+@pytest.mark.parametrize('request_type, fields', [
+    (SegmentRequest, {'model': 'rnn', 'length': 0, 'prefix': PREFIX}),
+    (SegmentRequest, {'model': 'rnn', 'length': 4, 'prefix': [1, 391]}),
+    (ContinueRequest, {'length': 0}),
+    (ContinueRequest, {'length': -3}),
+])
+def test_segment_requests_are_validated(request_type, fields):
+    with pytest.raises(ValidationError):
+        request_type(**fields)
+
+
+def test_empty_prefix_is_refused_before_a_session_starts():
+    sessions = len(main.sessions)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.start_segments(SegmentRequest(model='rnn', length=4, prefix=[])))
+    assert error.value.status_code == 422
+    assert len(main.sessions) == sessions
+
+
+def test_empty_segment_is_refused():
+    model = build_model('rnn')
+    logits, state = model.prime(torch.tensor([PREFIX]))
+    with pytest.raises(ValueError):
+        decode_segment(model, logits, state, len(PREFIX) - 1, 0)
+    with pytest.raises(ValueError):
+        generate_segment(model, 4, [])
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+import sessions as sessions_module
+from sessions import SessionStore
+from test_decoding import ScheduleModel
+from test_stream import FakeExecutor
+from util import ContinueRequest, SegmentRequest, generate_segment
+
+
+def test_least_recently_used_session_is_evicted():
+    store = SessionStore(max_sessions=2)
+    first, second = store.create('rnn', [1]), store.create('rnn', [1])
+    assert store.get(first.id) is first
+    store.create('rnn', [1])
+    assert store.get(second.id) is None and store.get(first.id) is first and len(store) == 2
+
+
+def test_session_expires_after_its_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(sessions_module.time, 'monotonic', lambda: now[0])
+    store = SessionStore(ttl=10)
+    session = store.create('rnn', [1])
+    now[0] += 5
+    assert store.get(session.id) is session
+    now[0] += 9
+    assert store.get(session.id) is session
+    now[0] += 11
+    assert store.get(session.id) is None and len(store) == 0
+
+
+def test_segments_carry_the_piece_on(monkeypatch):
+    monkeypatch.setattr(main, 'executor', FakeExecutor(ScheduleModel()))
+    monkeypatch.setattr(main, 'sessions', SessionStore())
+
+    async def run():
+        first = await main.start_segments(SegmentRequest(model='rnn', length=3, prefix=[1, 63]))
+        second = await main.continue_segments(first['id'], ContinueRequest(length=4))
+        return first, second
+
+    first, second = asyncio.run(run())
+    whole, _, _ = generate_segment(ScheduleModel(), 7, [1, 63])
+    assert first['tokens'] + second['tokens'] == whole
+    assert second['position'] == 2 + 7 and not second['finished']
+
+
+def test_unknown_session_is_404():
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.continue_segments('unknown', ContinueRequest(length=4)))
+    assert error.value.status_code == 404
@@ -0,0 +1,63 @@
+import pytest
+import torch
+
+from conftest import batch, build_model
+from model.decoding import decode
+from model.speculative import speculative_decode
+
+PREFIXES = [[1, 60, 300, 188], [1, 60], [1, 70, 280]]
+LENGTHS = [30, 24, 40]
+
+
+@pytest.mark.parametrize('draft', ['rnn', 'cnn', 'transformer'])
+@pytest.mark.parametrize('k', [1, 3, 5])
+def test_speculative_decoding_gives_the_model_output(draft, k):
+    model = build_model('transformer')
+    target, valid_len, prefix_len = batch(PREFIXES, LENGTHS)
+    with torch.no_grad():
+        expected = decode(model, target, valid_len, prefix_len)
+        outputs, proposed, accepted = speculative_decode(model, build_model(draft), target, valid_len, prefix_len, k=k)
+    assert torch.equal(outputs, expected)
+    assert 0 <= accepted <= proposed
+
+
+def test_draft_matching_the_model_has_every_token_accepted():
+    model = build_model('transformer')
+    target, valid_len, prefix_len = batch([PREFIXES[0]], [LENGTHS[0]])
+    with torch.no_grad():
+        _, proposed, accepted = speculative_decode(model, model, target, valid_len, prefix_len, k=4)
+    assert proposed > 0 and accepted == proposed
+
+
+class CheckedDraft:
+    """Draft that checks every step against the draft primed over the tokens consumed so far"""
+
+    def __init__(self, draft):
+        self.draft = draft
+        self.history = None
+        self.steps = 0
+
+    def prime(self, tokens):
+        self.history = tokens[0].tolist()
+        return self.draft.prime(tokens)
+
+    def step(self, tokens, state, t):
+        logits, state = self.draft.step(tokens, state, t)
+        # a rolled back draft steps again from an earlier position
+        self.history = self.history[:t] + tokens.tolist()
+        expected, _ = self.draft.prime(torch.tensor([self.history]))
+        assert torch.allclose(logits, expected, atol=1e-5)
+        self.steps += 1
+        return logits, state
+
+    def select_state(self, state, index):
+        return self.draft.select_state(state, index)
+
+
+def test_cnn_draft_resumes_from_the_state_before_its_rejected_tokens():
+    model, draft = build_model('transformer'), CheckedDraft(build_model('cnn'))
+    target, valid_len, prefix_len = batch([PREFIXES[0]], [LENGTHS[2]])
+    with torch.no_grad():
+        _, proposed, accepted = speculative_decode(model, draft, target, valid_len, prefix_len, k=4)
+    # some drafted tokens were rejected, so the draft was rolled back
+    assert accepted < proposed and draft.steps > 0
@@ -0,0 +1,88 @@
+import asyncio
+import json
+
+import pytest
+import torch
+from fastapi import HTTPException
+
+import main
+from conftest import batch, build_model
+from executor import QueueFullError
+from model.decoding import decode
+from model.speculative import SpeculativeModel
+from test_decoding import ScheduleModel, PREFIXES
+from util import GenerateRequest, generate_segment
+
+
+class FakeExecutor:
+    """Runs the chunks of a stream in place on `model`, failing from call `fail_at` on"""
+
+    def __init__(self, model, fail_at=None):
+        self.model = model
+        self.fail_at = fail_at
+        self.calls = 0
+
+    async def run(self, fn, name, length, prefix=None, carry=None, seed=None):
+        self.calls += 1
+        if self.fail_at is not None and self.calls >= self.fail_at:
+            raise QueueFullError()
+        return generate_segment(self.model, length, prefix, carry, seed)
+
+
+def stream(monkeypatch, payload, executor):
+    monkeypatch.setattr(main, 'executor', executor)
+    monkeypatch.setattr(main, 'STREAM_CHUNK', 3)
+
+    async def events():
+        response = await main.generate_stream(payload)
+        return [chunk async for chunk in response.body_iterator]
+
+    parsed = []
+    for frame in asyncio.run(events()):
+        event, data = frame.strip().split('\n')
+        parsed.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return parsed
+
+
+@pytest.mark.parametrize('prefix', PREFIXES[:2])
+@pytest.mark.parametrize('seconds', [None, 0.1, 0.25, 0.4])
+def test_stream_stops_where_decode_does(monkeypatch, prefix, seconds):
+    payload = GenerateRequest(model='rnn', length=len(prefix) + 12, prefix=prefix, duration=seconds)
+    events = stream(monkeypatch, payload, FakeExecutor(ScheduleModel()))
+    tokens = [token for event, data in events if event == 'tokens' for token in data['tokens']]
+    assert events[-1] == ('end', {'tokens': len(tokens)})
+
+    target, valid_len, prefix_len = batch([prefix], [payload.length])
+    duration = None if seconds is None else torch.tensor([seconds])
+    expected = decode(ScheduleModel(), target, valid_len, prefix_len, duration)[0, len(prefix) - 1:].tolist()
+    assert tokens == [token for token in expected if token != 0]
+
+
+def test_error_after_the_first_chunk_is_an_event(monkeypatch):
+    payload = GenerateRequest(model='rnn', length=20, prefix=[1, 60])
+    events = stream(monkeypatch, payload, FakeExecutor(ScheduleModel(), fail_at=2))
+    assert events[-1][0] == 'error' and events[-1][1]['status'] == 503
+    assert [event for event, _ in events].count('tokens') == 1
+
+
+def test_unfit_request_is_refused_before_the_stream_starts(monkeypatch):
+    monkeypatch.setattr(main, 'executor', FakeExecutor(ScheduleModel()))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.generate_stream(GenerateRequest(model='rnn', length=2, prefix=[1, 60])))
+    assert error.value.status_code == 422
+
+
+def test_stream_with_a_speculative_transformer_steps_the_model(monkeypatch):
+    model = build_model('transformer')
+    speculative = SpeculativeModel(model, build_model('rnn'))
+    prefix = [1, 60, 300, 188]
+    payload = GenerateRequest(model='transformer', length=20, prefix=prefix)
+    events = stream(monkeypatch, payload, FakeExecutor(speculative))
+    tokens = [token for event, data in events if event == 'tokens' for token in data['tokens']]
+    assert events[-1] == ('end', {'tokens': len(tokens)})
+
+    target, valid_len, prefix_len = batch([prefix], [payload.length])
+    with torch.no_grad():
+        expected = decode(model, target, valid_len, prefix_len)[0, len(prefix) - 1:].tolist()
+    # the stream leaves eos out
+    assert tokens == (expected[:expected.index(2)] if 2 in expected else expected)
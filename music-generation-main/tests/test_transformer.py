@@ -0,0 +1,21 @@
+import torch
+
+from model import transformer
+from model.transformer import PositionalEncoding, _sinusoid_table, positional_table
+
+
+def test_positional_table_grows_in_chunks():
+    dim = 6
+    small = positional_table(dim, torch.device('cpu'), 10)
+    assert small.shape[1] == transformer.PE_CHUNK_SIZE
+    grown = positional_table(dim, torch.device('cpu'), transformer.PE_CHUNK_SIZE + 1)
+    assert grown.shape[1] == 2 * transformer.PE_CHUNK_SIZE
+    assert torch.equal(grown[:, :small.shape[1]], small)
+    assert torch.allclose(grown, _sinusoid_table(dim, grown.shape[1], torch.device('cpu')))
+
+
+def test_positional_encoding_at_an_offset():
+    encoding = PositionalEncoding(8, torch.device('cpu'))
+    X = torch.zeros(2, 5, 8)
+    assert torch.allclose(encoding(X, offset=7), encoding(X, offset=7, shared=False), atol=1e-6)
+    assert torch.allclose(encoding(X, offset=7), _sinusoid_table(8, 12, torch.device('cpu'))[:, 7:].expand(2, 5, 8))
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from conftest import batch, build_model
+from model.scripted import script_decoder
+from scripting import ScriptedModel, load_scripted
+from test_decoding import cut_at_eos
+
+PREFIXES = [[1, 60, 300, 188, 70, 260, 190], [1, 62, 280]]
+
+
+def windowed(window):
+    model = build_model('transformer')
+    model.window = window
+    return model
+
+
+def test_cache_keeps_the_last_window_positions():
+    model = windowed(4)
+    with torch.no_grad():
+        _, cache = model.prime(torch.tensor([PREFIXES[0]]))
+        assert cache[0]['key'].shape[1] == 4 and cache[0]['evicted'] == 3
+        for t in range(7, 12):
+            _, cache = model.step(torch.tensor([60]), cache, t)
+    assert all(layer['key'].shape[1] == 4 and layer['evicted'] == 8 for layer in cache)
+
+
+def test_generation_goes_on_past_the_window():
+    target, valid_len, prefix_len = batch(PREFIXES, [40, 30])
+    model = windowed(4)
+    with torch.no_grad():
+        eager = model.predict(target, valid_len, prefix_len)
+        compiled = ScriptedModel(torch.jit.script(script_decoder('transformer', model).eval()))
+        # the compiled loop runs every row to the longest length, through its eos
+        compiled = cut_at_eos(compiled.predict(target, valid_len, prefix_len), prefix_len)
+    for i in range(len(PREFIXES)):
+        assert torch.equal(compiled[i, :valid_len[i] - 1], eager[i, :valid_len[i] - 1])
+    with torch.no_grad():
+        # a window holding the whole piece attends to everything
+        assert torch.equal(windowed(64).predict(target, valid_len, prefix_len),
+                           windowed(None).predict(target, valid_len, prefix_len))
+
+
+def test_compiled_artifact_is_rebuilt_for_another_window(tmp_path):
+    prefix = str(tmp_path / 'transformer')
+    torch.save({'model_state_dict': build_model('transformer').state_dict()}, f'{prefix}.pt')
+    built = []
+
+    def loader(window):
+        built.append(window)
+        return windowed(window)
+
+    assert load_scripted('transformer', lambda: loader(None), prefix).module.window == 0
+    assert load_scripted('transformer', lambda: loader(4), prefix, window=4).module.window == 4
+    # the artifact of the current window is reused
+    assert load_scripted('transformer', lambda: loader(4), prefix, window=4).module.window == 4
+    assert built == [None, 4]